@@ -0,0 +1,59 @@
+from collections import deque
+from threading import Lock
+
+from constants import *
+
+
+class AdmissionQueue:
+    '''Bounded queue of client requests with separate lanes for reads (GET, GET_AT, FIND) and writes (PUT, BATCH), reads are favored but writes are never starved'''
+
+    def __init__(self, capacity: int = QUEUE_CAPACITY, reads_per_write: int = READS_PER_WRITE):
+        self.capacity = capacity
+        self.reads_per_write = reads_per_write
+        self.reads = deque()
+        self.writes = deque()
+        # Reads served in a row while a write was waiting
+        self.streak = 0
+        self.lock = Lock()
+
+    def __len__(self) -> int:
+        return len(self.reads) + len(self.writes)
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.reads) + list(self.writes))
+
+    def __contains__(self, request_id) -> bool:
+        return any(r.operation.request_id == request_id for r in self)
+
+    def empty(self) -> bool:
+        return len(self) == 0
+
+    def clear(self):
+        with self.lock:
+            self.reads.clear()
+            self.writes.clear()
+            self.streak = 0
+
+    def put(self, request) -> bool:
+        '''Add request to its lane (returns False if queue is full)'''
+        with self.lock:
+            if len(self) >= self.capacity:
+                return False
+            if request.operation.op not in [OpType.PUT, OpType.BATCH]:
+                self.reads.append(request)
+            else:
+                self.writes.append(request)
+            return True
+
+    def get(self):
+        '''Remove and return next request (up to reads_per_write reads before each waiting write)'''
+        with self.lock:
+            if self.writes and (not self.reads or self.streak >= self.reads_per_write):
+                self.streak = 0
+                return self.writes.popleft()
+            if self.reads:
+                if self.writes:
+                    self.streak += 1
+                return self.reads.popleft()
+            return None
@@ -0,0 +1,66 @@
+import sys
+import time
+import random
+
+from dictionary import *
+from constants import *
+
+
+def benchmark_history(lengths=(1000, 10000, 100000), num_keys: int = 1000, reads: int = 10000):
+    '''Measure version index size and point-in-time read latency against blockchain length'''
+    print(f'{"Depth":>8} {"Retention":>10} {"Versions":>9} {"Index KB":>9} {"GET_AT us":>10}')
+
+    for length in lengths:
+        # Only operations are needed to update dictionary, so skip nonce calculation
+        blocks = [Object(operation=Operation(OpType.PUT, f'key_{i % num_keys}', i))
+                  for i in range(length)]
+
+        for retention in [HISTORY_RETENTION, float('inf')]:
+            d = Dictionary(retention=retention)
+            d.update(blocks, length, verbose=False)
+
+            versions = sum(len(depths) for depths, _ in d.history.values())
+            size = sys.getsizeof(d.history) + sum(
+                sys.getsizeof(depths) + sys.getsizeof(values) for depths, values in d.history.values())
+
+            queries = [(f'key_{random.randrange(num_keys)}', random.randint(d.history_start(), length))
+                       for _ in range(reads)]
+            start = time.perf_counter()
+            for key, depth in queries:
+                d.get_at(key, depth)
+            elapsed = (time.perf_counter() - start) / reads * 1e6
+
+            print(f'{length:>8} {str(retention):>10} {versions:>9} {size / 1024:>9.1f} {elapsed:>10.2f}')
+
+
+def benchmark_verify(length: int = 20000):
+    '''Measure parallel blockchain loading and verification time against number of worker processes'''
+    filename = f'benchmark_chain_{SELF_PID}.txt'
+    b = Blockchain()
+    b.filename = filename
+    offsets = []
+
+    # Write synthetic chain to backup file (without logging every append)
+    ptr = 0
+    with open(filename, 'wb') as f:
+        for i in range(length):
+            block = Block(Operation(OpType.PUT, f'key_{i}', i), ptr)
+            offsets.append(f.tell())
+            pickle.dump(block, f)
+            ptr = block.digest()
+
+    print(f'{"Workers":>8} {"Seconds":>8} {"Speedup":>8}')
+    baseline = None
+    workers = 1
+    while True:
+        start = time.perf_counter()
+        result = b.load(offsets, workers=workers)
+        elapsed = time.perf_counter() - start
+        baseline = baseline or elapsed
+        print(f'{workers:>8} {elapsed:>8.2f} {baseline / elapsed:>8.2f}' +
+              ('' if result == -1 else f' (invalid block #{result})'))
+        if workers >= os.cpu_count():
+            break
+        workers = min(workers * 2, os.cpu_count())
+
+    os.remove(filename)
@@ -0,0 +1,92 @@
+import os
+import math
+import zlib
+try:
+    import cPickle as pickle
+except:
+    import pickle
+from hashlib import sha256
+from threading import Lock
+from constants import *
+
+
+class BlobRef:
+    '''Stands in for a large operation value (value is stored and transferred separately, by content hash)'''
+
+    def __init__(self, digest: str, size: int, chunks: int):
+        self.digest = digest  # Hash of serialized value
+        self.size = size  # Size of serialized value (bytes)
+        self.chunks = chunks  # Number of compressed chunks
+
+    def __str__(self) -> str:
+        return f'<blob {self.digest[:16]}, {self.size} bytes>'
+
+
+class BlobStore:
+    '''Content-addressed store of compressed values on disk (identical values are only stored once)'''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        # Chunks of blobs being received: digest --> {index: data}
+        self.partial = {}
+        self.lock = Lock()
+
+    def __contains__(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.directory, digest)
+
+    def _write(self, digest: str, data: bytes):
+        if digest in self:
+            return
+        # Write to temporary file first so partially written blobs are never read
+        tmp = self._path(digest) + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, self._path(digest))
+
+    def put(self, value, threshold: int = BLOB_THRESHOLD):
+        '''Store value and return reference to it if its serialized size reaches threshold, otherwise return value'''
+        raw = pickle.dumps(value)
+        if len(raw) < threshold:
+            return value
+        digest = sha256(raw).hexdigest()
+        data = zlib.compress(raw, BLOB_COMPRESSION)
+        self._write(digest, data)
+        return BlobRef(digest, len(raw), math.ceil(len(data) / BLOB_CHUNK_SIZE))
+
+    def get(self, ref):
+        '''Value referenced by ref (None if blob has not been received), other values are returned as is'''
+        if not isinstance(ref, BlobRef):
+            return ref
+        try:
+            with open(self._path(ref.digest), 'rb') as f:
+                return pickle.loads(zlib.decompress(f.read()))
+        except IOError:
+            return None
+
+    def chunks(self, digest: str):
+        '''Compressed blob split into chunks for transfer'''
+        with open(self._path(digest), 'rb') as f:
+            data = f.read()
+        return [data[i:i + BLOB_CHUNK_SIZE] for i in range(0, len(data), BLOB_CHUNK_SIZE)]
+
+    def add_chunk(self, digest: str, index: int, count: int, data: bytes) -> bool:
+        '''Collect received chunk, returns True once blob is complete and matches its digest'''
+        with self.lock:
+            if digest in self:
+                return False
+            chunks = self.partial.setdefault(digest, {})
+            chunks[index] = data
+            if len(chunks) < count:
+                return False
+
+            del self.partial[digest]
+            data = b''.join(chunks[i] for i in range(count))
+            if sha256(zlib.decompress(data)).hexdigest() != digest:
+                log(f'Discarding blob {digest[:16]}: digest mismatch')
+                return False
+            self._write(digest, data)
+            return True
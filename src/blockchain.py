@@ -1,54 +1,116 @@
 import os
+import math
+import time
+import pickletools
 try:
     import cPickle as pickle
 except:
     import pickle
 from hashlib import sha256
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from constants import *
 from threading import Lock
 
 a_lock = Lock()
 
 
+def valid_nonce(operation: Operation, nonce: str) -> bool:
+    '''Check proof of work (last digit of hash of operation concatenated with nonce is between 0 and 2)'''
+    h = sha256((str(operation) + nonce).encode()).hexdigest()
+    return int(h, base=16) % 10 <= 2
+
+
+def skip_pickle(f):
+    '''Move file past pickled object at its position without unpickling it (raises ValueError if object is truncated or unreadable)'''
+    start = f.tell()
+    if f.read(2)[:1] == pickle.PROTO:
+        # Protocol 4+ objects are split into frames of known length, so only frame headers are read
+        while f.read(1) == pickle.FRAME:
+            length = int.from_bytes(f.read(8), 'little')
+            f.seek(length - 1, os.SEEK_CUR)
+            last = f.read(1)
+            if not last:
+                raise ValueError('pickle truncated in frame')
+            # Object ends with STOP in its last frame, followed by next object or end of file
+            if last == pickle.STOP and f.peek(1)[:1] in [b'', pickle.PROTO]:
+                return
+    # Unframed object (or large value written outside frames), parse opcodes up to STOP
+    f.seek(start)
+    for _ in pickletools.genops(f):
+        pass
+
+
+def load_range(filename: str, offset: int, count: int, hash_pointer, verify: bool = True):
+    '''Load blocks stored in backup file from offset (run in worker process), returns index of first invalid block (or -1), valid blocks and their digests
+    (hash pointer of first block is checked by caller if None)'''
+    blocks, digests = [], []
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        for i in range(count):
+            try:
+                block = pickle.load(f)
+            except Exception:  # Unreadable block
+                return i, blocks, digests
+            if verify and (hash_pointer not in [None, block.hash_pointer] or
+                           not valid_nonce(block.operation, block.nonce)):
+                return i, blocks, digests
+            hash_pointer = block.digest()
+            blocks.append(block)
+            digests.append(hash_pointer)
+    return -1, blocks, digests
+
+
 class Block:
     '''Block represents one block in the blockchain (stores operation, hash pointer to previous block, and nonce)'''
 
-    def __init__(self, operation: Operation, hash_pointer: str, tentative: bool = False):
+    def __init__(self, operation: Operation, hash_pointer: str, tentative: bool = False, timestamp: float = None):
         self.operation = operation
         self.hash_pointer = hash_pointer
         self.nonce = self.calculate_nonce()
         self.tentative = tentative
+        # Time block was proposed (expiry of values with a TTL is derived from it)
+        self.timestamp = timestamp
 
     def __str__(self) -> str:
         result = f'   ├──{self.operation.op}: {self.operation.key}'
         if self.operation.value:
             result += f' --> {self.operation.value}'
+        if getattr(self.operation, 'ttl', None) is not None:
+            result += f'\n   ├──TTL: {self.operation.ttl}'
+        if getattr(self, 'timestamp', None) is not None:
+            result += f'\n   ├──Timestamp: {self.timestamp}'
         result += f'\n   ├──Hash pointer: {self.hash_pointer}'
         result += f'\n   └──Nonce: {self.nonce}'
         return result
 
+    def digest(self) -> str:
+        '''Hash of block (used as hash pointer by the following block)'''
+        return sha256(str(self).encode()).hexdigest()
+
     def calculate_nonce(self) -> str:
         h = nonce = 0
 
-        # Repeat until last digit of h is between 0 and 2
+        # Repeat until last digit of hash is between 0 and 2
         while True:
             nonce = generate_random_string(10)
-            # Hash current operation concatenated with nonce
-            h = sha256((str(self.operation) + nonce).encode()).hexdigest()
-            # Ensure last digit is between 0 and 2
-            if int(h, base=16) % 10 <= 2:
+            if valid_nonce(self.operation, nonce):
                 return nonce
 
 
 class Blockchain:
     '''Append-only data structure which holds each operation in a block'''
 
-    def __init__(self, filename: str = ''):
+    def __init__(self, filename: str = '', verify: bool = VERIFY_ON_RESTORE):
         self.blocks = []
         self.depth = 0
+        # Digest of each block, which also summarizes every block before it (via hash pointers)
+        self.digests = []
         self.filename = filename
+        # Depth of first corrupted block found in backup (None if backup is intact)
+        self.corrupted = None
         if filename != '':
-            self.restore(filename)
+            self.restore(filename, verify)
 
     def __str__(self) -> str:
         result = f'Blockchain depth: {self.depth}'
@@ -57,37 +119,113 @@ class Blockchain:
             result += str(b)
         return result
 
-    def restore(self, filename: str = ''):
+    def restore(self, filename: str = '', verify: bool = False):
+        offsets = []  # Position of each block in backup file
         try:
             with (open(filename, "rb")) as f:
                 log('Restoring blockchain from file...')
-                while True:
+                # Blocks are only located here, they are unpickled by the loading processes
+                while f.peek(1):
+                    offsets.append(f.tell())
                     try:
-                        # Load block and append to blockchain
-                        self.blocks.append(pickle.load(f))
-                        self.depth += 1
-                        log(f'+ added block #{len(self.blocks)}')
-                    except EOFError:  # Reached end of file
+                        skip_pickle(f)
+                    except ValueError as e:  # Unreadable block
+                        log(f'Failed to read block #{len(offsets) - 1}: {e}')
+                        offsets.pop()
+                        self.corrupted = len(offsets)
                         break
         except IOError:  # File does not exist
             return
-        return
 
-    def generate_next_block(self, op: Operation) -> Block:
-        if len(self.blocks):
-            ptr = sha256(str(self.blocks[-1]).encode()).hexdigest()
-        else:
-            ptr = 0
+        bad = self.load(offsets, verify)
+        if bad != -1 and (self.corrupted is None or bad < self.corrupted):
+            self.corrupted = bad
+        log(f'Restored {self.depth} blocks')
+        if self.corrupted is not None:
+            log(f'Backup corrupted at block #{self.corrupted}, truncating')
+            self.truncate(self.corrupted)
+
+    def load(self, offsets, verify: bool = True, workers: int = VERIFY_WORKERS) -> int:
+        '''Load blocks at given offsets of backup file in parallel (verifying hash pointers and nonces, recording digests),
+        returns depth of first invalid block or -1'''
+        n = len(offsets)
+        self.blocks, self.digests = [], []
+        self.depth = 0
+        if n == 0:
+            return -1
+        workers = workers or os.cpu_count()
+        size = math.ceil(n / workers)
+        starts = list(range(0, n, size))
+
+        log(f'{"Verifying" if verify else "Loading"} {n} blocks using {len(starts)} processes...')
+        # Fork explicitly: spawned workers would re-run main.py (which has no __main__ guard)
+        with ProcessPoolExecutor(len(starts), mp_context=multiprocessing.get_context('fork')) as pool:
+            results = pool.map(
+                load_range,
+                [self.filename] * len(starts),
+                [offsets[s] for s in starts],
+                [min(size, n - s) for s in starts],
+                # First block of every other range must point to last block of range before it (checked below)
+                [0 if s == 0 else None for s in starts],
+                [verify] * len(starts)
+            )
+
+            for start, (result, blocks, digests) in zip(starts, results):
+                if verify and blocks and blocks[0].hash_pointer != self.prefix_digest(start):
+                    return start
+                self.blocks += blocks
+                self.digests += digests
+                self.depth = len(self.blocks)
+                if result != -1:
+                    return start + result
+        return -1
+
+    def truncate(self, depth: int):
+        '''Discard blocks from given depth onward'''
+        del self.blocks[depth:]
+        del self.digests[depth:]
+        self.depth = depth
+        self._rewrite_file()
+
+    def decided_depth(self) -> int:
+        '''Number of decided (non-tentative) blocks in blockchain'''
+        return self.depth - 1 if self.is_tentative() else self.depth
+
+    def next_hash_pointer(self):
+        '''Hash pointer for block following the last decided block (tentative block is skipped)'''
+        return self.prefix_digest(self.decided_depth())
+
+    def prefix_digest(self, depth: int):
+        '''Summary of first depth blocks (equal on two servers only if all of those blocks are equal)'''
+        if depth:
+            return self.digests[depth - 1]
+        return 0
 
+    def checkpoints(self, low: int, high: int, fanout: int = ANTI_ENTROPY_FANOUT):
+        '''Prefix digests at evenly spaced depths in (low, high], used to narrow down divergent ranges'''
+        step = max(1, math.ceil((high - low) / fanout))
+        depths = list(range(low + step, high, step)) + [high]
+        return [(d, self.prefix_digest(d)) for d in depths]
+
+    def generate_next_block(self, op: Operation) -> Block:
         return Block(
             operation=op,
-            hash_pointer=ptr
+            hash_pointer=self.next_hash_pointer(),
+            timestamp=time.time()
         )
 
     def _add_to_file(self, block: Block):
         with open(self.filename, "ab") as f:
             pickle.dump(block, f)
 
+    def _rewrite_file(self):
+        # Erase contents of backup file
+        open(self.filename, 'wb').close()
+
+        # Rewrite backup
+        for b in self.blocks:
+            self._add_to_file(b)
+
     def is_tentative(self):
         '''Determine whether or not last block in blockchain is tentative'''
         return len(self.blocks) and self.blocks[-1].tentative
@@ -102,22 +240,18 @@ class Blockchain:
 
             # Verify validity of block
             # Check hash pointer
-            if len(self.blocks):
-                ptr = sha256(str(self.blocks[-1]).encode()).hexdigest()
-            else:
-                ptr = 0
+            ptr = self.prefix_digest(len(self.blocks))
             if ptr != block.hash_pointer:  # Abort if hash pointer is incorrect
                 log('Aborting append operation: invalid hash pointer')
                 return
             # Check nonce
-            h = sha256((str(block.operation) +
-                        block.nonce).encode()).hexdigest()
-            if int(h, base=16) % 10 > 2:  # Abort if last digit of nonce exceeds 2
+            if not valid_nonce(block.operation, block.nonce):
                 log('Aborting append operation: invalid nonce')
                 return
 
             # Add block to blockchain
             self.blocks.append(block)
+            self.digests.append(block.digest())
             self.depth += 1
 
             # Add block to backup file
@@ -127,13 +261,8 @@ class Blockchain:
         log(f'Updating block #{len(self.blocks) - 1}')
         # Replace last block in blockchain
         self.blocks[-1] = block
-
-        # Erase contents of backup file
-        open(self.filename, 'wb').close()
-
-        # Rewrite backup
-        for b in self.blocks:
-            self._add_to_file(b)
+        self.digests[-1] = block.digest()
+        self._rewrite_file()
 
         # # Delete last line of file
         # with open(self.filename, 'rb+') as f:
@@ -0,0 +1,27 @@
+import csv
+import json
+from constants import *
+
+
+def read_pairs(filename: str):
+    '''Stream key-value pairs from JSON lines ({"key": ..., "value": ...}) or CSV file (key column, other columns form value)'''
+    with open(filename, newline='') as f:
+        if filename.endswith('.csv'):
+            for row in csv.DictReader(f):
+                key = row.pop('key')
+                yield key, row
+        else:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    yield record['key'], record.get('value')
+
+
+def write_records(filename: str, records) -> int:
+    '''Stream records to JSON lines file (one line per record), returns number of records written'''
+    count = 0
+    with open(filename, 'w') as f:
+        for record in records:
+            f.write(json.dumps(record, default=str) + '\n')
+            count += 1
+    return count
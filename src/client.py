@@ -1,19 +1,38 @@
 import time
 import random
+from collections import OrderedDict
 
 from messages import *
 from blockchain import *
 from dictionary import *
+from bulk import *
 from constants import *
 
 
 class Client:
     def __init__(self):
         self.m = Messenger(self.message_handler)
-        self.leaderID = 0
+        # Leader of each shard (initial hints spread leadership across servers)
+        self.leaderID = [shard % NUM_SERVERS for shard in range(NUM_SHARDS)]
         self.requests = []
+        self.next_request = 0  # Sequence number of next request
+        # Target shard of requests which are not routed by key: request ID --> shard
+        self.request_shard = {}
+        # Watched prefixes: (prefix, shard) --> depth to resume from (None if not yet known)
+        self.watches = {}
         self.WAIT_TIME = 30
 
+        # Read cache: key --> (value, depth read at, expiry time), least recently used first
+        self.cache = OrderedDict()
+        self.cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        # Depth up to which invalidations have been received from each shard (None if not subscribed)
+        self.cache_depth = [None for _ in range(NUM_SHARDS)]
+
+        # Bulk import: batches awaiting decision and number of keys in each (request ID --> keys)
+        self.import_window = threading.Semaphore(IMPORT_WINDOW)
+        self.import_sizes = {}
+        self.imported = 0
+
     def connect(self):
         self.m.connect()
 
@@ -23,37 +42,194 @@ class Client:
     def send_message(self, message, pid: int = -1, recipientType: str = 'Server'):
         self.m.send_message(message, pid, recipientType)
 
-    def send_request(self, op: Operation):
+    def send_to_leader(self, message, shard: int):
+        '''Send message to (presumed) leader of shard'''
+        self.send_message(message, shard * NUM_SERVERS + self.leaderID[shard])
+
+    def send_request(self, op: Operation, use_cache: bool = True):
+        # Answer repeated reads locally
+        if op.op == OpType.GET and CLIENT_CACHE_SIZE:
+            # Expired values are dropped (expiry is not announced by invalidations)
+            if op.key in self.cache and self.cache[op.key][2] is not None \
+                    and self.cache[op.key][2] <= time.time():
+                del self.cache[op.key]
+            if use_cache and op.key in self.cache:
+                self.cache.move_to_end(op.key)
+                self.cache_stats['hits'] += 1
+                log(f'Request fulfilled from cache: GET {op.key}')
+                log(f'Response: {self.cache[op.key][0]}')
+                return
+            self.cache_stats['misses'] += 1
+            self.subscribe_invalidations(shard_of(op.key))
+
+        # Secondary index queries are sent to every shard
+        if op.op == OpType.FIND:
+            for shard in range(NUM_SHARDS):
+                query = Operation(op.op, op.key, op.value,
+                                  (SELF_PID, self.next_request))
+                self.next_request += 1
+                self.request_shard[query.request_id] = shard
+                threading.Thread(
+                    target=self.send_request_thread,
+                    args=[query]
+                ).start()
+            return
+
+        op.request_id = (SELF_PID, self.next_request)
+        self.next_request += 1
         threading.Thread(
             target=self.send_request_thread,
             args=[op]
         ).start()
 
+    def shard_of_request(self, op: Operation) -> int:
+        return self.request_shard.get(op.request_id, shard_of(op.key))
+
     def send_request_thread(self, op: Operation):
+        shard = self.shard_of_request(op)
         self.requests.append(op)
-        self.send_message(ClientRequest(op), self.leaderID)
-        log(f'Sent request to server {self.leaderID}, waiting {self.WAIT_TIME} seconds...')
+        self.send_to_leader(ClientRequest(op), shard)
+        # Batches wait behind the other batches in flight, so a slow batch does not mean the leader failed
+        # (pending requests are moved to a new leader when it announces itself)
+        if op.op == OpType.BATCH:
+            log(f'Sent batch to server {self.leaderID[shard]}, waiting {IMPORT_TIMEOUT} seconds...')
+            while True:
+                time.sleep(IMPORT_TIMEOUT)
+                if op not in self.requests:
+                    break
+                log('Batch timed out, sending it again to the same leader...')
+                self.send_to_leader(ClientRequest(op), shard)
+            return
+
+        log(f'Sent request to server {self.leaderID[shard]}, waiting {self.WAIT_TIME} seconds...')
         while True:
             time.sleep(self.WAIT_TIME)
             if op in self.requests:
                 log(f'Request timed out, sending new request with leader hint...')
-                pid = random.randint(0, NUM_SERVERS - 1)
-                self.leaderID = pid
-                self.send_message(ClientRequest(op, force_leader=True), pid)
+                self.leaderID[shard] = random.randint(0, NUM_SERVERS - 1)
+                self.send_to_leader(ClientRequest(op, force_leader=True), shard)
                 log(
-                    f'Sent request to server {self.leaderID}, waiting {self.WAIT_TIME} seconds...')
+                    f'Sent request to server {self.leaderID[shard]}, waiting {self.WAIT_TIME} seconds...')
             else:
                 break
 
+    def bulk_import(self, filename: str, batch_size: int = IMPORT_BATCH_SIZE):
+        '''Stream key-value pairs from file to the leader of each shard, batch_size pairs per block'''
+        log(f'Importing {filename}...')
+        start = time.time()
+        self.imported = 0
+        batches = [[] for _ in range(NUM_SHARDS)]
+        for key, value in read_pairs(filename):
+            shard = shard_of(key)
+            batches[shard].append((key, value))
+            if len(batches[shard]) >= batch_size:
+                self.send_batch(batches[shard])
+                batches[shard] = []
+        for batch in batches:
+            if batch:
+                self.send_batch(batch)
+
+        # Wait for remaining batches to be decided
+        for _ in range(IMPORT_WINDOW):
+            self.import_window.acquire()
+        for _ in range(IMPORT_WINDOW):
+            self.import_window.release()
+        elapsed = time.time() - start
+        log(f'Imported {self.imported} keys in {elapsed:.1f} seconds ({self.imported / elapsed:.0f} keys/s)')
+
+    def send_batch(self, pairs: list):
+        # Block until a batch is decided if too many are in flight
+        self.import_window.acquire()
+        op = Operation(OpType.BATCH, pairs[0][0], Batch(pairs))
+        self.send_request(op)
+        self.import_sizes[op.request_id] = len(pairs)
+
+    def batch_fulfilled(self, op: Operation):
+        self.imported += self.import_sizes.pop(op.request_id, 0)
+        self.import_window.release()
+        log(f'Imported {self.imported} keys')
+
+    def watch(self, prefix: str, depth: int = None):
+        '''Subscribe to PUT operations on keys starting with prefix (resumes from last notification if depth is None)'''
+        for shard in range(NUM_SHARDS):
+            if depth is not None:
+                self.watches[(prefix, shard)] = depth
+            else:
+                self.watches.setdefault((prefix, shard), None)
+            self.send_to_leader(
+                Subscribe(prefix, self.watches[(prefix, shard)]), shard)
+
+    def unwatch(self, prefix: str):
+        for shard in range(NUM_SHARDS):
+            self.watches.pop((prefix, shard), None)
+            self.send_to_leader(Unsubscribe(prefix), shard)
+
+    def subscribe_invalidations(self, shard: int, force: bool = False):
+        '''Watch all keys of shard (without values) to invalidate cached reads'''
+        if self.cache_depth[shard] is None or force:
+            self.send_to_leader(
+                Subscribe('', self.cache_depth[shard], keys_only=True), shard)
+
+    def invalidate(self, notification: Notification):
+        for depth, key, _ in notification.changes:
+            if key in self.cache and self.cache[key][1] < depth:
+                del self.cache[key]
+                self.cache_stats['invalidations'] += 1
+        self.cache_depth[notification.shard] = max(
+            notification.depth, self.cache_depth[notification.shard] or 0)
+
+    def cache_response(self, response: ClientResponse):
+        o = response.operation
+        shard = shard_of(o.key)
+        # Cache only if no invalidations beyond read depth could have been missed
+        if response.depth is None or self.cache_depth[shard] is None or response.depth < self.cache_depth[shard]:
+            return
+        self.cache[o.key] = (response.message, response.depth, response.expires)
+        self.cache.move_to_end(o.key)
+        if len(self.cache) > CLIENT_CACHE_SIZE:
+            self.cache.popitem(last=False)
+
+    def print_cache(self):
+        print(f'Cache size: {len(self.cache)}')
+        print(f'   Hits: {self.cache_stats["hits"]}')
+        print(f'   Misses: {self.cache_stats["misses"]}')
+        print(f'   Invalidations: {self.cache_stats["invalidations"]}')
+        for key, (value, depth, expires) in self.cache.items():
+            if expires is not None:
+                print(f'   {key} --> {value} (block #{depth}, expires {expires})')
+            else:
+                print(f'   {key} --> {value} (block #{depth})')
+
+    def retry_request(self, op: Operation):
+        if op in self.requests:
+            self.send_to_leader(ClientRequest(op), self.shard_of_request(op))
+
     def request_fulfilled(self, response: ClientResponse):
         o = response.operation
         if o.op == OpType.GET:
             log(f'Request fulfilled: GET {o.key}')
+        elif o.op == OpType.GET_AT:
+            log(f'Request fulfilled: GET {o.key} @ depth {o.value}')
+        elif o.op == OpType.FIND:
+            log(f'Request fulfilled: FIND {o.key} in {o.value}')
+            self.request_shard.pop(o.request_id, None)
+        elif o.op == OpType.BATCH:
+            log(f'Request fulfilled: BATCH from {o.key}')
+            # Repeated responses must not widen import window
+            if o in self.requests:
+                self.batch_fulfilled(o)
         else:
             log(f'Request fulfilled: PUT {o.key} --> {o.value}')
         log(f'Response: {response.message}')
         self.requests = [r for r in self.requests if r != o]
 
+        if CLIENT_CACHE_SIZE:
+            if o.op == OpType.GET:
+                self.cache_response(response)
+            # Read own writes
+            elif o.op == OpType.PUT:
+                self.cache.pop(o.key, None)
+
     def message_handler(self, msg):
         log(f'Message received ({str(type(msg))})')
 
@@ -62,9 +238,40 @@ class Client:
             # PRINT RESPONSE
             self.request_fulfilled(msg)
 
-        # Update Leader
-        elif type(msg) is Decide:
-            self.leaderID = msg.ballot.pid
+        # Cached keys changed
+        elif type(msg) is Notification and msg.keys_only:
+            self.invalidate(msg)
+
+        # Watched keys changed
+        elif type(msg) is Notification:
+            if (msg.prefix, msg.shard) in self.watches:
+                for depth, key, value in msg.changes:
+                    log(f'Watch "{msg.prefix}": {key} --> {value} (block #{depth})')
+                self.watches[(msg.prefix, msg.shard)] = max(
+                    msg.depth, self.watches[(msg.prefix, msg.shard)] or 0)
+
+        # Leader is busy, retry later (with jitter to avoid retrying in lockstep)
+        elif type(msg) is Busy:
+            log(f'Leader busy, retrying in {msg.retry_after} seconds')
+            threading.Timer(
+                msg.retry_after + random.uniform(0, 1),
+                self.retry_request,
+                args=[msg.operation]
+            ).start()
+
+        # New leader elected, resend pending requests without waiting for timeout
+        elif type(msg) is LeaderChange:
+            if msg.leaderID != self.leaderID[msg.shard]:
+                self.leaderID[msg.shard] = msg.leaderID
+                for op in self.requests:
+                    if self.shard_of_request(op) == msg.shard:
+                        self.send_to_leader(ClientRequest(op), msg.shard)
+                # Previous leader may have failed, resume invalidations and watches from new leader
+                if self.cache_depth[msg.shard] is not None:
+                    self.subscribe_invalidations(msg.shard, force=True)
+                for (prefix, shard), depth in list(self.watches.items()):
+                    if shard == msg.shard:
+                        self.send_to_leader(Subscribe(prefix, depth), shard)
 
         # Test
         elif type(msg) is Test:
@@ -1,29 +1,74 @@
 '''Global constants and helper functions'''
 
 import sys
+import zlib
 import socket
 import string
 import random
 from enum import Enum
+from hashlib import sha256
 
 # Constants
 
 IP = socket.gethostname()  # IP Address
 NUM_CLIENTS = 3  # Number of clients
-NUM_SERVERS = 5  # Number of servers
+NUM_SERVERS = 5  # Number of servers (per shard)
+NUM_SHARDS = 1  # Number of shards (each is an independent Paxos group)
 
 CLIENT_PORTS = [2201 + x for x in range(NUM_CLIENTS)]
-SERVER_PORTS = [3201 + x for x in range(NUM_SERVERS)]
+SHARD_PORTS = [[3201 + 100 * shard + x for x in range(NUM_SERVERS)]
+               for shard in range(NUM_SHARDS)]
+
+NETWORK_DELAY = 2  # Simulated network delay (seconds)
+HEARTBEAT_INTERVAL = 0.1  # Time between leader heartbeats (seconds)
+ELECTION_TIMEOUT = 0.5  # Time without heartbeats before leader is suspected (seconds)
+ELECTION_BACKOFF = 0.5  # Maximum random delay added to election timeout (seconds)
+OUTGOING_QUEUE_SIZE = 1000  # Maximum number of unsent messages buffered per node
+THRIFTY_QUORUM = True  # Send accept requests to a bare majority first (widened on timeout)
+ACCEPT_TIMEOUT = 2 * NETWORK_DELAY + 1  # Time before accept requests are widened (seconds)
+QUEUE_CAPACITY = 100  # Maximum number of client requests queued on the leader
+READS_PER_WRITE = 4  # Reads served before a waiting write (so writes are not starved by a stream of reads)
+RETRY_AFTER = 5  # Time clients wait before retrying a request rejected as busy (seconds)
+DEDUP_WINDOW = 10000  # Number of recently decided requests remembered for duplicate suppression
+HISTORY_RETENTION = 1000  # Number of most recent blocks for which point-in-time reads are kept
+WATCH_BATCH_SIZE = 100  # Maximum number of changes per watch notification
+WATCH_MAX_PENDING = 100  # Unsent messages to a client above which its notifications are paused
+WATCH_INTERVAL = 1  # Time between retries of paused watch notifications (seconds)
+CLIENT_CACHE_SIZE = 1000  # Maximum number of GET results cached by each client (0 disables cache)
+SECONDARY_INDEXES = ['phone_number']  # Value fields indexed for FIND queries
+VERIFY_ON_RESTORE = True  # Verify hash pointers and nonces of blockchain restored from backup
+VERIFY_WORKERS = None  # Processes used for verification (None uses every core)
+ANTI_ENTROPY_INTERVAL = 10  # Time between blockchain comparisons with the leader (seconds)
+ANTI_ENTROPY_FANOUT = 16  # Prefix digests per anti-entropy probe (divergence found in log_fanout(depth) rounds)
+BLOB_THRESHOLD = 64 * 1024  # Serialized size above which values are stored as blobs, referenced by digest (bytes)
+BLOB_CHUNK_SIZE = 64 * 1024  # Size of compressed blob chunks sent between servers (bytes)
+BLOB_COMPRESSION = 6  # zlib compression level of blobs
+BLOB_REQUEST_TIMEOUT = 3 * NETWORK_DELAY  # Time before a missing blob is requested again (seconds)
+RECOVERY_TIMEOUT = 3 * NETWORK_DELAY  # Time before missing decided blocks are requested again (seconds)
+EXPIRE_INTERVAL = 1  # Time between reclamations of expired keys (seconds)
+IMPORT_BATCH_SIZE = 5000  # Number of key-value pairs written per block by bulk imports
+IMPORT_WINDOW = 4  # Maximum number of bulk import batches awaiting decision (bounds client memory)
+IMPORT_TIMEOUT = 90  # Time before a bulk import batch is resent (batches are queued behind each other, seconds)
+EXPORT_CHUNK_SIZE = 1000  # Number of keys looked up at a time by exports
+PROFILE_INTERVAL = 0.01  # Time between stack samples of the sampling profiler (seconds)
+PROFILE_DURATION = 30  # Default time a profiler runs before its report is written (seconds)
+PROFILE_TOP = 40  # Number of functions listed in profile reports
 
 args = [str(sys.argv[1]), int(sys.argv[2])]
 SELF_PID = args[1]  # Process ID of this client (passed as argument)
+# Shard of this server (passed as optional argument)
+SELF_SHARD = int(sys.argv[3]) if len(sys.argv) > 3 else 0
 
 # Type of node (either 'client' or 'server')
 if args[0].lower() in ['c', 'client']:
     SELF_TYPE = 'Client'
     SELF_PORT = CLIENT_PORTS[SELF_PID]
+    # Clients connect to the servers of every shard
+    SERVER_PORTS = [port for ports in SHARD_PORTS for port in ports]
 elif args[0].lower() in ['s', 'server']:
     SELF_TYPE = 'Server'
+    # Servers only connect to the servers of their own shard
+    SERVER_PORTS = SHARD_PORTS[SELF_SHARD]
     SELF_PORT = SERVER_PORTS[SELF_PID]
 
 
@@ -34,28 +79,70 @@ class OpType(Enum):
     '''Dictionary operation types enumeration'''
     GET = 1
     PUT = 2
+    GET_AT = 3  # GET as of blockchain depth (depth is passed as operation value)
+    FIND = 4  # Keys whose value field (operation key) is within (low, high) range (passed as operation value)
+    BATCH = 5  # PUT of every key-value pair in Batch (passed as operation value, key is first key of batch)
+
+
+class Batch:
+    '''Key-value pairs written by one BATCH operation (printed as number of pairs and hash of contents)'''
+
+    def __init__(self, pairs: list):
+        self.pairs = pairs
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def __iter__(self):
+        return iter(self.pairs)
+
+    def __str__(self) -> str:
+        return f'<{len(self.pairs)} pairs, {sha256(repr(self.pairs).encode()).hexdigest()}>'
 
 
 class Operation:
     '''Operation object stores operation type, key, and value (one per block)'''
 
-    def __init__(self, op: OpType, key, value=None):
+    def __init__(self, op: OpType, key, value=None, request_id=None, ttl: float = None):
         self.op = op
         self.key = key
         self.value = value
+        # Identifies client request (client PID, sequence number) for duplicate suppression
+        self.request_id = request_id
+        # Seconds after the block is proposed that a PUT value expires (None if it never expires)
+        self.ttl = ttl
 
     def __eq__(self, other):
-        return [self.op, self.key] == [other.op, other.key]
+        return [self.op, self.key, self.request_id] == [other.op, other.key, other.request_id]
 
     def __str__(self):
         result = f'   ├──Type: {self.op}'
         if self.op == OpType.PUT:
             result += f'\n   ├──Key: {self.key}'
+            if getattr(self, 'ttl', None) is not None:
+                result += f'\n   ├──TTL: {self.ttl}'
             result += f'\n   └──Value: {self.value}'
+        elif self.op == OpType.GET_AT:
+            result += f'\n   ├──Key: {self.key}'
+            result += f'\n   └──Depth: {self.value}'
+        elif self.op == OpType.FIND:
+            result += f'\n   ├──Field: {self.key}'
+            result += f'\n   └──Range: {self.value}'
+        elif self.op == OpType.BATCH:
+            result += f'\n   ├──First key: {self.key}'
+            result += f'\n   └──Pairs: {self.value}'
         else:
             result += f'\n   └──Key: {self.key}'
         return result
 
+    def writes(self, resolve=None) -> list:
+        '''Key-value pairs written by operation (resolve replaces batch stored separately by its pairs)'''
+        if self.op == OpType.PUT:
+            return [(self.key, self.value)]
+        if self.op == OpType.BATCH:
+            return list(self.value if resolve is None else resolve(self.value))
+        return []
+
 
 # Anonymous object creator
 Object = lambda **kwargs: type("Object", (), kwargs)
@@ -65,7 +152,15 @@ Object = lambda **kwargs: type("Object", (), kwargs)
 
 
 def log(message: str):
-    print(f'({SELF_TYPE} {SELF_PID}): {message}')
+    if NUM_SHARDS > 1 and SELF_TYPE == 'Server':
+        print(f'({SELF_TYPE} {SELF_PID}, shard {SELF_SHARD}): {message}')
+    else:
+        print(f'({SELF_TYPE} {SELF_PID}): {message}')
+
+
+def shard_of(key) -> int:
+    '''Shard responsible for key (stable across processes, unlike hash())'''
+    return zlib.crc32(str(key).encode()) % NUM_SHARDS
 
 
 def generate_random_string(length: int, acceptableChars: str = string.ascii_letters + string.digits) -> str:
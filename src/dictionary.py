@@ -1,12 +1,136 @@
+import time
+import heapq
+from collections import deque
+from bisect import bisect_left, bisect_right, insort
+from threading import RLock
 from blockchain import *
 from constants import *
 from typing import List
 
+expiry_lock = RLock()
+
+
+def sort_key(value):
+    '''Key ordering values of any type (numbers, then strings, then other values grouped by type)'''
+    if isinstance(value, (int, float)):
+        return (0, value)
+    if isinstance(value, str):
+        return (1, value)
+    return (2, type(value).__name__, repr(value))
+
+
+class SortedBlocks:
+    '''Sorted list split into blocks of bounded size (inserts and removals move at most one block)'''
+
+    def __init__(self, load: int = 1000):
+        self.load = load
+        self.blocks = []
+        self.maxes = []  # Last item of each block
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def add(self, item):
+        if not self.blocks:
+            self.blocks.append([item])
+            self.maxes.append(item)
+            self.size += 1
+            return
+        # Block holding first larger item (or last block)
+        b = min(bisect_left(self.maxes, item), len(self.blocks) - 1)
+        block = self.blocks[b]
+        insort(block, item)
+        self.maxes[b] = block[-1]
+        self.size += 1
+        if len(block) > 2 * self.load:
+            self.blocks[b:b + 1] = [block[:self.load], block[self.load:]]
+            self.maxes[b:b + 1] = [block[self.load - 1], block[-1]]
+
+    def remove(self, item) -> bool:
+        '''Remove item if present, returns whether it was'''
+        b = bisect_left(self.maxes, item)
+        if b == len(self.blocks):
+            return False
+        block = self.blocks[b]
+        i = bisect_left(block, item)
+        if i == len(block) or block[i] != item:
+            return False
+        del block[i]
+        self.size -= 1
+        if block:
+            self.maxes[b] = block[-1]
+        else:
+            del self.blocks[b]
+            del self.maxes[b]
+        return True
+
+    def irange(self, low):
+        '''Items from the first one not less than low onward'''
+        b = bisect_left(self.maxes, low)
+        if b == len(self.blocks):
+            return
+        yield from self.blocks[b][bisect_left(self.blocks[b], low):]
+        for block in self.blocks[b + 1:]:
+            yield from block
+
+
+class SecondaryIndex:
+    '''Sorted (field value, key) pairs for a value field, supports range lookups in O(log n + k)'''
+
+    def __init__(self, field: str):
+        self.field = field
+        # (sort key of field value, sort key of key, key), so values and keys of any type can be ordered
+        self.entries = SortedBlocks()
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def _field_value(self, value):
+        if isinstance(value, dict):
+            return value.get(self.field)
+        return None
+
+    def add(self, key, value):
+        v = self._field_value(value)
+        if v is not None:
+            self.entries.add((sort_key(v), sort_key(key), key))
+
+    def remove(self, key, value):
+        v = self._field_value(value)
+        if v is not None:
+            self.entries.remove((sort_key(v), sort_key(key), key))
+
+    def find(self, low, high=None) -> list:
+        '''Keys whose field value is between low and high (inclusive), or equal to low if high is None'''
+        high = sort_key(low if high is None else high)
+        keys = []
+        for v, _, key in self.entries.irange((sort_key(low),)):
+            if v > high:
+                break
+            keys.append(key)
+        return keys
+
 
 class Dictionary:
-    def __init__(self, filename: str = ''):
+    def __init__(self, filename: str = '', retention: int = HISTORY_RETENTION, indexes: List[str] = SECONDARY_INDEXES):
         self.data = {}
         self.latestDepth = 0
+        # Version index: key --> ([depths], [values]), depths in ascending order
+        self.history = {}
+        self.retention = retention
+        # Secondary indexes: field --> SecondaryIndex
+        self.indexes = {}
+        for field in indexes:
+            self.create_index(field)
+        # Expiry time of keys with a TTL: key --> time
+        self.expiry = {}
+        # Pending expirations (expiry time, key), earliest first (superseded entries are skipped when popped)
+        self.expirations = []
+        # Depth at which expired keys were reclaimed: key --> depth (their history is dropped outside retention window)
+        self.reclaimed = {}
+        # Reclaimed keys (depth, key) in order of reclamation (superseded entries are skipped)
+        self.reclamations = deque()
         self.filename = filename
         if filename != '':
             self.restore(filename)
@@ -22,7 +146,7 @@ class Dictionary:
         return result
 
     def __getitem__(self, key):
-        if key in self.data:
+        if key in self.data and not self.expired(key):
             return self.data[key]
         else:
             return 'NO_KEY'
@@ -30,11 +154,116 @@ class Dictionary:
     def __setitem__(self, key, value):
         self.data[key] = value
 
-    def update(self, blocks: List[Block], depth: int):
+    def items(self, chunk_size: int = EXPORT_CHUNK_SIZE):
+        '''Unexpired key-value pairs, looked up in chunks from a snapshot of the keys (keys removed meanwhile are skipped)'''
+        keys = list(self.data)
+        for i in range(0, len(keys), chunk_size):
+            with expiry_lock:
+                now = time.time()
+                chunk = [(key, self.data[key]) for key in keys[i:i + chunk_size]
+                         if key in self.data and not self.expired(key, now)]
+            yield from chunk
+
+    def create_index(self, field: str):
+        '''Declare secondary index on value field (built from current data)'''
+        index = SecondaryIndex(field)
+        for key, value in self.data.items():
+            index.add(key, value)
+        self.indexes[field] = index
+
+    def find(self, field: str, low, high=None):
+        '''Keys whose value field is between low and high (or equal to low), using secondary index'''
+        if field not in self.indexes:
+            return 'NO_INDEX'
+        return [key for key in self.indexes[field].find(low, high) if not self.expired(key)]
+
+    def expired(self, key, now: float = None) -> bool:
+        '''Whether key has expired (expired keys are hidden before they are reclaimed)'''
+        return key in self.expiry and self.expiry[key] <= (now or time.time())
+
+    def expire(self, now: float = None) -> int:
+        '''Reclaim keys which have expired by now, returns number of keys removed'''
+        now = now or time.time()
+        removed = 0
+        with expiry_lock:
+            while self.expirations and self.expirations[0][0] <= now:
+                t, key = heapq.heappop(self.expirations)
+                # Key was overwritten since (with another expiry time or none)
+                if self.expiry.get(key) != t:
+                    continue
+                del self.expiry[key]
+                for index in self.indexes.values():
+                    index.remove(key, self.data[key])
+                del self.data[key]
+                self.reclaimed[key] = self.latestDepth
+                self.reclamations.append((self.latestDepth, key))
+                removed += 1
+
+            # Versions of reclaimed keys are only needed for reads within retention window
+            start = self.history_start()
+            while self.reclamations and self.reclamations[0][0] < start:
+                depth, key = self.reclamations.popleft()
+                # Key was written again since
+                if self.reclaimed.get(key) != depth:
+                    continue
+                del self.reclaimed[key]
+                self.history.pop(key, None)
+        return removed
+
+    def get_at(self, key, depth: int):
+        '''Value of key as of given blockchain depth'''
+        if depth < self.history_start():
+            return 'HISTORY_UNAVAILABLE'
+        if key not in self.history:
+            return 'NO_KEY'
+        depths, values = self.history[key]
+        i = bisect_right(depths, depth)
+        return values[i - 1] if i else 'NO_KEY'
+
+    def history_start(self) -> int:
+        '''Earliest depth for which point-in-time reads are guaranteed'''
+        return max(0, self.latestDepth - self.retention)
+
+    def _add_version(self, key, value, depth: int):
+        depths, values = self.history.setdefault(key, ([], []))
+        depths.append(depth)
+        values.append(value)
+
+        # Drop versions superseded before retention window (keep the one in effect at its start)
+        i = bisect_right(depths, depth - self.retention) - 1
+        if i > 0:
+            del depths[:i]
+            del values[:i]
+
+    def update(self, blocks: List[Block], depth: int, verbose: bool = True, resolve=None):
         # Iterate through missing blocks and execute PUT operations
         for i in range(self.latestDepth, depth):
-            if blocks[i].operation.op is OpType.PUT:
-                self.data[blocks[i].operation.key] = blocks[i].operation.value
-                log(
-                    f'Updating dictionary: ({blocks[i].operation.key}: {blocks[i].operation.value})')
+            writes = blocks[i].operation.writes(resolve)
+            for key, value in writes:
+                # Expired keys are reclaimed concurrently
+                with expiry_lock:
+                    for index in self.indexes.values():
+                        if key in self.data:
+                            index.remove(key, self.data[key])
+                        index.add(key, value)
+                    self.data[key] = value
+                    self.reclaimed.pop(key, None)
+                    self._set_expiry(key, blocks[i])
+                self._add_version(key, value, i + 1)
+                if verbose and blocks[i].operation.op is OpType.PUT:
+                    log(f'Updating dictionary: ({key}: {value})')
+            if verbose and blocks[i].operation.op is OpType.BATCH:
+                log(f'Updating dictionary: {len(writes)} keys')
         self.latestDepth = depth  # Update depth
+        self.expire()
+
+    def _set_expiry(self, key, block: Block):
+        # Expiry is derived from the decided block so every replica agrees on it
+        ttl = getattr(block.operation, 'ttl', None)
+        with expiry_lock:
+            if ttl is None:
+                self.expiry.pop(key, None)
+            else:
+                t = block.timestamp + ttl
+                self.expiry[key] = t
+                heapq.heappush(self.expirations, (t, key))
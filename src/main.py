@@ -7,6 +7,8 @@ from messages import *
 from blockchain import *
 from server import *
 from client import *
+from benchmark import *
+from profiler import *
 
 from constants import *
 
@@ -65,14 +67,47 @@ def handle_input():
                 s.send_message(Test("Hello there"), int(target), 'Client')
 
         # 1 -- operation [OP] [KEY] [VALUE]: Issue PUT/GET request (client expects response with result or acknowledgement)
-        if i.startswith('op'):
+        # op find [FIELD] [VALUE] or op find [FIELD] [LOW]..[HIGH]: Find keys by value field (using secondary index)
+        if i.startswith('op find'):
+            if SELF_TYPE == 'Client':
+                command, op, field, value = i.split(' ', 3)
+                low, high = value.split('..') if '..' in value else (value, None)
+                s.send_request(Operation(OpType.FIND, field, (low, high)))
+
+        elif i.startswith('op'):
             if SELF_TYPE == 'Client':
                 user_input = i.split(' ')
                 if len(user_input) == 3:
                     user_input += [None]
+                # op put [KEY] [VALUE] [TTL]: Value expires TTL seconds after it is proposed
+                ttl = float(user_input.pop()) if len(user_input) == 5 else None
                 command, op, key, value = user_input
-                op = OpType.GET if op.lower() == 'get' else OpType.PUT
-                s.send_request(Operation(op, key, value))
+                use_cache = True
+                if op.lower() == 'get':
+                    op = OpType.GET
+                    # op get [KEY] nocache: Bypass client read cache
+                    use_cache = value != 'nocache'
+                    value = None
+                elif op.lower() == 'getat':  # op getat [KEY] [DEPTH]
+                    op = OpType.GET_AT
+                    value = int(value)
+                else:
+                    op = OpType.PUT
+                s.send_request(Operation(op, key, value, ttl=ttl), use_cache)
+
+        # watch [PREFIX] [DEPTH]: Subscribe to changes of keys starting with prefix (optionally from given depth)
+        if i.startswith('watch'):
+            if SELF_TYPE == 'Client':
+                user_input = i.split(' ')
+                prefix = user_input[1] if len(user_input) > 1 else ''
+                depth = int(user_input[2]) if len(user_input) > 2 else None
+                s.watch(prefix, depth)
+
+        # unwatch [PREFIX]: Cancel subscription
+        if i.startswith('unwatch'):
+            if SELF_TYPE == 'Client':
+                user_input = i.split(' ')
+                s.unwatch(user_input[1] if len(user_input) > 1 else '')
 
         # 2 -- failLink [TYPE] [DEST]: Simulates communication failure between self and destination node (ignores incoming/outgoing messages)
         if 'failLink' in i:
@@ -104,13 +139,49 @@ def handle_input():
             if SELF_TYPE == 'Server':
                 print(str(s.d))
 
+        # import [FILE]: Write key-value pairs from JSON lines or CSV file in batched blocks
+        if i.startswith('import '):
+            if SELF_TYPE == 'Client':
+                threading.Thread(target=s.bulk_import,
+                                 args=[i.split(' ')[1]]).start()
+
+        # export [FILE] [history]: Write key-value store (or history of decided writes) to JSON lines file
+        if i.startswith('export '):
+            if SELF_TYPE == 'Server':
+                user_input = i.split(' ')
+                s.export(user_input[1], 'history' in user_input[2:])
+
+        # benchmarkHistory: Measure version index size and point-in-time read latency against blockchain length
+        if i == 'benchmarkHistory':
+            benchmark_history()
+
+        # printCache: Print the client read cache and its hit/miss/invalidation counters
+        if i in ['printCache', 'pc']:
+            if SELF_TYPE == 'Client':
+                s.print_cache()
+
+        # benchmarkVerify: Measure parallel blockchain loading and verification time against number of processes
+        if i == 'benchmarkVerify':
+            benchmark_verify()
+
+        # profile start [sampling|deterministic] [SECONDS]: Profile this node, report is written to file when done
+        # profile stop: Stop profiling early
+        if i.startswith('profile'):
+            user_input = i.split(' ')
+            if len(user_input) > 1 and user_input[1] == 'start':
+                mode = user_input[2] if len(user_input) > 2 else 'sampling'
+                seconds = float(user_input[3]) if len(user_input) > 3 else PROFILE_DURATION
+                start_profiler(s.m, mode, seconds)
+            elif len(user_input) > 1 and user_input[1] == 'stop':
+                stop_profiler()
+
         # 7 -- printQueue: Print the pending operations present on the queue
         if i in ['printQueue', 'pq']:
             if SELF_TYPE == 'Server':
                 print(f'Queue size: {len(s.queue)}')
-                for i, op in enumerate(s.queue):
-                    print(f'   Operation #{i}:', end='')
-                    print(str(op))
+                for i, request in enumerate(s.queue):
+                    print(f'   Operation #{i}:')
+                    print(str(request.operation))
 
 
 threading.Thread(target=handle_input).start()
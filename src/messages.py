@@ -1,11 +1,21 @@
+import os
 import time
 import sys
 import socket
+import struct
 import pickle
 import threading
+from queue import Queue, Full, Empty
 
 from constants import *
 
+# Maximum number of buffers written by a single sendmsg call (1024 where the limit is unknown)
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+IOV_MAX = IOV_MAX if IOV_MAX > 0 else 1024
+
 
 # Server-Server Multi-Paxos Messages
 
@@ -42,18 +52,19 @@ class PrepareRequest:
         self.depth = depth
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 class Promise:
-    '''Phase 1B'''
+    '''Phase 1B (accepted maps each undecided depth to its accepted ballot and block)'''
 
-    def __init__(self, ballot: Ballot, acceptNum, acceptVal, depth: int):
+    def __init__(self, ballot: Ballot, accepted: dict, depth: int):
         self.ballot = ballot
-        self.num = acceptNum
-        self.value = acceptVal
+        self.accepted = accepted
         self.depth = depth
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 class AcceptRequest:
@@ -65,27 +76,42 @@ class AcceptRequest:
         self.depth = depth
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 class Accept:
-    '''Phase 2B'''
+    '''Phase 2B (only the digest of the accepted block is sent back)'''
 
-    def __init__(self, ballot: Ballot, value, depth: int):
+    def __init__(self, ballot: Ballot, digest: str, depth: int):
         self.ballot = ballot
-        self.value = value
+        self.digest = digest
         self.depth = depth
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 class Decide:
-    '''Phase 3'''
+    '''Phase 3 (value is omitted for servers which already accepted the block with given digest)'''
 
-    def __init__(self, ballot: Ballot, value):
+    def __init__(self, ballot: Ballot, depth: int, digest: str, value=None):
         self.ballot = ballot
+        self.depth = depth
+        self.digest = digest
         self.value = value
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class Heartbeat:
+    '''Periodic leader liveness message'''
+
+    def __init__(self, ballot: Ballot):
+        self.ballot = ballot
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 # Client-Server Messages
@@ -96,14 +122,75 @@ class ClientRequest:
         self.force_leader = force_leader
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 class ClientResponse:
-    def __init__(self, op: Operation, message: str = ""):
+    def __init__(self, op: Operation, message: str = "", depth: int = None, expires: float = None):
         self.operation = op
         self.message = message
+        self.depth = depth  # Depth of blockchain when response was generated
+        self.expires = expires  # Time value expires (None if it does not)
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class Busy:
+    '''Leader queue is full, client should retry after given number of seconds'''
+
+    def __init__(self, op: Operation, retry_after: float):
+        self.operation = op
+        self.retry_after = retry_after
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class LeaderChange:
+    '''Notifies clients of newly elected leader'''
+
+    def __init__(self, leaderID: int):
+        self.leaderID = leaderID
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+# Watch Messages (change feed of decided PUT operations)
+
+class Subscribe:
+    '''Watch keys starting with prefix, from given depth (or from now on if None), keys_only omits values'''
+
+    def __init__(self, prefix: str, depth: int = None, keys_only: bool = False):
+        self.prefix = prefix
+        self.depth = depth
+        self.keys_only = keys_only
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class Unsubscribe:
+    def __init__(self, prefix: str, keys_only: bool = False):
+        self.prefix = prefix
+        self.keys_only = keys_only
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class Notification:
+    '''Changes as (depth, key, value) tuples, depth is where the next notification resumes'''
+
+    def __init__(self, prefix: str, changes: list, depth: int, keys_only: bool = False):
+        self.prefix = prefix
+        self.changes = changes
+        self.depth = depth
+        self.keys_only = keys_only
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 # Recovery Messages (resynchronization for nodes missing blocks)
@@ -114,6 +201,62 @@ class RecoveryData:
         self.block = block
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class RecoveryRequest:
+    '''Ask servers for blocks from given depth onward (e.g. after discarding corrupted backup)'''
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class SyncProbe:
+    '''Anti-entropy: prefix digests at checkpoint depths in (low, high], blocks up to low are known to match'''
+
+    def __init__(self, low: int, high: int, checkpoints: list):
+        self.low = low
+        self.high = high
+        self.checkpoints = checkpoints  # [(depth, prefix digest)]
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class SyncDiverged:
+    '''Anti-entropy: blockchains differ from given depth onward (blocks from there must be repaired)'''
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class BlobRequest:
+    '''Ask for chunks of blob with given digest'''
+
+    def __init__(self, digest: str):
+        self.digest = digest
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
+
+
+class BlobChunk:
+    '''One compressed chunk of a blob (sent separately from the consensus messages referencing it)'''
+
+    def __init__(self, digest: str, index: int, count: int, data: bytes):
+        self.digest = digest
+        self.index = index
+        self.count = count
+        self.data = data
+        self.pid = SELF_PID
+        self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 # Debugging Messages
@@ -123,6 +266,7 @@ class Test:
         self.message = message
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 # Other Messages
@@ -131,6 +275,7 @@ class Quit:
     def __init__(self):
         self.pid = SELF_PID
         self.nodeType = SELF_TYPE
+        self.shard = SELF_SHARD
 
 
 # Messenger class
@@ -140,11 +285,28 @@ class Messenger:
 
     def __init__(self, message_handler):
         self.clients = [None for _ in range(NUM_CLIENTS)]
-        self.servers = [None for _ in range(NUM_SERVERS)]
+        self.servers = [None for _ in range(len(SERVER_PORTS))]
         self.failed_links = Object(clients=[], servers=[])
         self.message_handler = message_handler
         self.connected = False
 
+        # Outgoing (serialized) messages awaiting transmission to each node
+        self.outgoing = {
+            'Client': [Queue(OUTGOING_QUEUE_SIZE) for _ in range(NUM_CLIENTS)],
+            'Server': [Queue(OUTGOING_QUEUE_SIZE) for _ in range(len(SERVER_PORTS))]
+        }
+        # Prevent writes to the same socket from interleaving
+        self.send_locks = {
+            'Client': [threading.Lock() for _ in range(NUM_CLIENTS)],
+            'Server': [threading.Lock() for _ in range(len(SERVER_PORTS))]
+        }
+        for nodeType, queues in self.outgoing.items():
+            for pid in range(len(queues)):
+                threading.Thread(
+                    target=self.outgoing_connection_handler,
+                    args=(nodeType, pid)
+                ).start()
+
         # Prepare to receive incoming connections
         self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.s.bind((IP, SELF_PORT))     # Bind to port
@@ -161,8 +323,7 @@ class Messenger:
             if SELF_TYPE != 'Client':  # Clients do not connect to other clients
                 for i, port in enumerate(CLIENT_PORTS):
                     try:
-                        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        s.connect((IP, port))  # Connect to client
+                        s = self.open_socket(port)  # Connect to client
                         self.clients[i] = s    # Add socket to list of clients
                         log(f'Connected to client @ {IP}:{port}')
                     except:
@@ -172,13 +333,19 @@ class Messenger:
             for i, port in enumerate(SERVER_PORTS):
                 if SELF_TYPE != 'Server' or port != SELF_PORT:  # Exclude self
                     try:
-                        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        s.connect((IP, port))  # Connect to server
+                        s = self.open_socket(port)  # Connect to server
                         self.servers[i] = s    # Add socket to list of servers
                         log(f'Connected to server @ {IP}:{port}')
                     except:
                         log(f'Server is unreachable')
 
+    def open_socket(self, port):
+        '''Open outgoing connection (Nagle disabled, since small messages are coalesced before sending)'''
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        s.connect((IP, port))
+        return s
+
     def reconnect(self):
         '''Re-establish connections (find broken sockets and reconnect)'''
 
@@ -186,27 +353,31 @@ class Messenger:
         if SELF_TYPE != 'Client':  # Clients do not connect to other clients
             for i, (client, port) in enumerate(zip(self.clients, CLIENT_PORTS)):
                 try:
-                    client.sendall(self.serialize_message('PING'))
+                    with self.send_locks['Client'][i]:
+                        client.sendall(self.serialize_message('PING'))
                 except:
-                    # Recreate socket and reconnect
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.connect((IP, port))    # Connect to client
-                    self.clients[i] = s      # Add socket to list of clients
-                    log(f'Reconnected to client @ {IP}:{port}')
-                    return
+                    try:
+                        # Recreate socket and reconnect
+                        s = self.open_socket(port)  # Connect to client
+                        self.clients[i] = s      # Add socket to list of clients
+                        log(f'Reconnected to client @ {IP}:{port}')
+                    except:
+                        self.clients[i] = None
 
         # Reconnect to servers
         for i, (server, port) in enumerate(zip(self.servers, SERVER_PORTS)):
             if SELF_TYPE != 'Server' or port != SELF_PORT:  # Exclude self
                 try:
-                    server.sendall(self.serialize_message('PING'))
+                    with self.send_locks['Server'][i]:
+                        server.sendall(self.serialize_message('PING'))
                 except:
-                    # Recreate socket and reconnect
-                    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    s.connect((IP, port))    # Connect to server
-                    self.servers[i] = s      # Add socket to list of server
-                    log(f'Reconnected to server @ {IP}:{port}')
-                    return
+                    try:
+                        # Recreate socket and reconnect
+                        s = self.open_socket(port)  # Connect to server
+                        self.servers[i] = s      # Add socket to list of server
+                        log(f'Reconnected to server @ {IP}:{port}')
+                    except:
+                        self.servers[i] = None
 
     def close(self):
         '''Close all connections, outgoing and incoming'''
@@ -269,37 +440,30 @@ class Messenger:
 
     def incoming_connection_handler(self, connection, address):
         log(f'Incoming connection from client @ {address}')
+        # Received bytes not yet framed into messages (appended in place, consumed from the front)
+        buffer = bytearray()
 
         while True:
             try:
                 # Receive data from client
-                message = connection.recv(1024)
-                if not message:
+                data = connection.recv(65536)
+                if not data:
                     log(f'Node @ {address} disconnected.')
                     connection.close()
                     break
 
-                message = self.deserialize_message(message)
-
-                # Close outgoing connection if node quits
-                if type(message) is Quit:
-                    index = message.pid
-                    if message.nodeType == 'Server':
-                        log('Closing outgoing server connection')
-                        self.servers[index].close()
-                        self.servers[index] = None
-                    else:
-                        log('Closing outgoing client connection')
-                        self.clients[index].close()
-                        self.clients[index] = None
-
-                # Handle message (check failed_links to simulate failures)
-                elif hasattr(message, 'pid') and hasattr(message, 'nodeType'):
-                    if not self.is_failed(message.nodeType, message.pid):
-                        threading.Thread(
-                            target=self.message_handler,
-                            args=[message]
-                        ).start()
+                # Split stream into length-prefixed messages
+                buffer += data
+                offset = 0
+                while len(buffer) - offset >= 4:
+                    size = struct.unpack_from('>I', buffer, offset)[0]
+                    if len(buffer) - offset < 4 + size:
+                        break
+                    message = self.deserialize_message(
+                        buffer[offset + 4:offset + 4 + size])
+                    offset += 4 + size
+                    self.handle_incoming_message(message)
+                del buffer[:offset]
 
             # Close client connection
             except socket.error as e:
@@ -307,56 +471,130 @@ class Messenger:
                 connection.close()
                 break
 
-    def send_message(self, message, pid=-1, recipientType='Server'):
+    def sender_index(self, message):
+        '''Index of sender in server/client lists (clients list the servers of every shard)'''
+        if SELF_TYPE == 'Client' and message.nodeType == 'Server':
+            return message.shard * NUM_SERVERS + message.pid
+        return message.pid
+
+    def handle_incoming_message(self, message):
+        # Close outgoing connection if node quits
+        if type(message) is Quit:
+            index = self.sender_index(message)
+            if message.nodeType == 'Server':
+                log('Closing outgoing server connection')
+                if self.servers[index] is not None:
+                    self.servers[index].close()
+                self.servers[index] = None
+            else:
+                log('Closing outgoing client connection')
+                if self.clients[index] is not None:
+                    self.clients[index].close()
+                self.clients[index] = None
+
+        # Handle message (check failed_links to simulate failures)
+        elif hasattr(message, 'pid') and hasattr(message, 'nodeType'):
+            if not self.is_failed(message.nodeType, self.sender_index(message)):
+                threading.Thread(
+                    target=self.message_handler,
+                    args=[message]
+                ).start()
+
+    def send_message(self, message, pid=-1, recipientType='Server', delay=NETWORK_DELAY, verbose=True):
         '''Send message to node of given process ID (or all servers if none is specified)'''
         if not self.connected:
-            log('Not connected')
+            if verbose:
+                log('Not connected')
             return
 
-        if pid == -1:
-            if recipientType == 'All':
-                log(f'Sending message to all nodes ({str(type(message))})')
+        if verbose:
+            if pid == -1:
+                if recipientType == 'All':
+                    log(f'Sending message to all nodes ({str(type(message))})')
+                else:
+                    log(
+                        f'Sending message to all {recipientType.lower()}s ({str(type(message))})')
+            elif type(pid) is list:
+                log(f'Sending message to {recipientType}s {pid} ({str(type(message))})')
             else:
-                log(
-                    f'Sending message to all {recipientType.lower()}s ({str(type(message))})')
-        else:
-            log(f'Sending message to {recipientType} #{pid} ({str(type(message))})')
+                log(f'Sending message to {recipientType} #{pid} ({str(type(message))})')
 
         threading.Thread(
             target=self.send_message_thread,
-            args=[message, pid, recipientType]
+            args=[message, pid, recipientType, delay]
         ).start()
 
-    def send_message_thread(self, message, pid=-1, recipientType='Server'):
-        time.sleep(2)  # Simulated network delays
+    def send_message_thread(self, message, pid=-1, recipientType='Server', delay=NETWORK_DELAY):
+        time.sleep(delay)  # Simulated network delays
 
+        # Serialize once, the same buffer is shared by every recipient
         try:
-            # If receipient PID is specified, send to single recipient
-            if pid != -1:
-                if not self.is_failed(recipientType, pid):
-                    if recipientType in ['Server', 'All']:
-                        self.servers[pid].sendall(
-                            self.serialize_message(message))
-                    elif recipientType in ['Client', 'All']:
-                        self.clients[pid].sendall(
-                            self.serialize_message(message))
-
-            # If not PID is specified, send to all clients
-            else:
-                if recipientType in ['Server', 'All']:
-                    for i, server in enumerate(self.servers):
-                        if server is not None and not self.is_failed('Server', i):
-                            server.sendall(self.serialize_message(message))
-                if recipientType in ['Client', 'All']:
-                    for i, client in enumerate(self.clients):
-                        if client is not None and not self.is_failed('Client', i):
-                            client.sendall(self.serialize_message(message))
+            data = self.serialize_message(message)
         except Exception as e:
-            log(e)
+            log(f'Failed to serialize {type(message).__name__}: {e}')
+            return
+
+        # If list of recipient PIDs is specified, send to each recipient
+        if type(pid) is list:
+            for i in pid:
+                if not self.is_failed(recipientType, i):
+                    self.enqueue_message(data, recipientType, i)
+
+        # If receipient PID is specified, send to single recipient
+        elif pid != -1:
+            if not self.is_failed(recipientType, pid):
+                if recipientType in ['Server', 'All']:
+                    self.enqueue_message(data, 'Server', pid)
+                elif recipientType in ['Client', 'All']:
+                    self.enqueue_message(data, 'Client', pid)
+
+        # If not PID is specified, send to all clients
+        else:
+            if recipientType in ['Server', 'All']:
+                for i, server in enumerate(self.servers):
+                    if server is not None and not self.is_failed('Server', i):
+                        self.enqueue_message(data, 'Server', i)
+            if recipientType in ['Client', 'All']:
+                for i, client in enumerate(self.clients):
+                    if client is not None and not self.is_failed('Client', i):
+                        self.enqueue_message(data, 'Client', i)
+
+    def enqueue_message(self, data: bytes, nodeType: str, pid: int):
+        '''Hand serialized message to node's outgoing queue (dropped if node is too far behind)'''
+        try:
+            self.outgoing[nodeType][pid].put_nowait(data)
+        except Full:
+            log(f'Outgoing queue for {nodeType} #{pid} is full, dropping message')
+
+    def outgoing_connection_handler(self, nodeType: str, pid: int):
+        '''Write queued messages to a single node (a slow node only delays its own messages)'''
+        q = self.outgoing[nodeType][pid]
+        sockets = self.servers if nodeType == 'Server' else self.clients
+
+        while True:
+            # Coalesce pending messages into a single write (up to the system's limit on buffers per write)
+            buffers = [q.get()]
+            try:
+                while len(buffers) < IOV_MAX:
+                    buffers.append(q.get_nowait())
+            except Empty:
+                pass
+
+            s = sockets[pid]
+            if s is None:
+                continue
+            try:
+                with self.send_locks[nodeType][pid]:
+                    sent = s.sendmsg(buffers)
+                    if sent < sum(len(b) for b in buffers):
+                        s.sendall(b''.join(buffers)[sent:])
+            except Exception as e:
+                log(f'Failed to send to {nodeType} #{pid}: {e}')
 
     def serialize_message(self, message):
-        '''Serialize message prior to transmission'''
-        return pickle.dumps(message)
+        '''Serialize message prior to transmission (prefixed with its length)'''
+        data = pickle.dumps(message)
+        return struct.pack('>I', len(data)) + data
 
     def deserialize_message(self, message):
         '''Deserialize message upon receipt'''
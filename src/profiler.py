@@ -0,0 +1,212 @@
+import os
+import re
+import sys
+import time
+import pstats
+import cProfile
+import threading
+from collections import Counter, defaultdict
+from threading import Lock
+from constants import *
+
+profiler_lock = Lock()
+active = None  # Running profiler (None if not profiling)
+
+
+def thread_group(name: str) -> str:
+    '''Thread name without its counter (e.g. "Thread-12 (send_message_thread)" --> "send_message_thread")'''
+    match = re.search(r'\((\w+)\)$', name)
+    return match.group(1) if match else name
+
+
+def function_name(code) -> str:
+    return f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+
+
+def thread_cpu_time(ident: int):
+    '''CPU time used by thread so far (None where per-thread clocks are unsupported)'''
+    try:
+        return time.clock_gettime(time.pthread_getcpuclockid(ident))
+    except (AttributeError, OSError):
+        return None
+
+
+class SamplingProfiler:
+    '''Samples the stack of every running thread at a fixed interval (low overhead)'''
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.samples = 0
+        self.running = False
+        self.self_time = Counter()  # Function --> CPU seconds spent running it
+        self.total_time = Counter()  # Function --> CPU seconds spent with it on the stack
+        self.threads = defaultdict(Counter)  # Thread --> function --> CPU seconds spent running it
+
+    def start(self):
+        self.running = True
+        self.started = time.time()
+        self.cpu_started = time.process_time()
+        self.own_cpu = 0  # CPU time used by sampling
+        threading.Thread(target=self.sample_thread, daemon=True).start()
+
+    def stop(self):
+        self.running = False
+        self.elapsed = time.time() - self.started
+        self.cpu_used = time.process_time() - self.cpu_started
+
+    def cpu_window(self, idents, me: int) -> dict:
+        '''Fraction of a short window each thread spent using CPU (None where per-thread clocks are unsupported)'''
+        before = {ident: thread_cpu_time(ident) for ident in idents if ident != me}
+        start = time.monotonic()
+        time.sleep(self.interval / 2)
+        length = time.monotonic() - start
+        window = {}
+        for ident, cpu in before.items():
+            after = thread_cpu_time(ident)
+            # Threads which exited meanwhile count as idle
+            window[ident] = None if cpu is None else ((after or cpu) - cpu) / length
+        return window
+
+    def sample_thread(self):
+        me = threading.get_ident()
+        last = time.monotonic()
+        while self.running:
+            time.sleep(self.interval)
+            names = {t.ident: thread_group(t.name) for t in threading.enumerate()}
+            # Stacks are read first, threads using CPU right after are running in them
+            # (a thread blocked by now may have used CPU earlier, somewhere else)
+            frames = sys._current_frames()
+            window = self.cpu_window(frames, me)
+            # Window is a random slice of the time since last sample, so its CPU usage is extrapolated to all of it
+            period, last = time.monotonic() - last, time.monotonic()
+            for ident, usage in window.items():
+                # Every thread counts as busy where its CPU time cannot be measured
+                weight = self.interval if usage is None else usage * period
+                if weight <= 0:
+                    continue
+
+                frame = frames[ident]
+                leaf = function_name(frame.f_code)
+                self.self_time[leaf] += weight
+                self.threads[names.get(ident, str(ident))][leaf] += weight
+                stack = set()
+                while frame is not None:
+                    stack.add(function_name(frame.f_code))
+                    frame = frame.f_back
+                for function in stack:
+                    self.total_time[function] += weight
+            self.samples += 1
+            self.own_cpu = thread_cpu_time(me) or 0
+
+    def report(self, f):
+        total = sum(self.self_time.values()) or 1
+        f.write(f'Sampling profile: {self.samples} samples over {self.elapsed:.1f} seconds, '
+                f'{total:.3f} CPU seconds sampled ({self.cpu_used:.3f} used by process, '
+                f'{self.own_cpu:.3f} of them by the profiler)\n\n')
+        f.write('Per function (CPU seconds):\n')
+        f.write(f'{"self":>10} {"self %":>7} {"total":>10}  function\n')
+        for function, t in self.self_time.most_common(PROFILE_TOP):
+            f.write(f'{t:10.3f} {100 * t / total:6.1f}% {self.total_time[function]:10.3f}  {function}\n')
+
+        f.write('\nPer thread (CPU seconds):\n')
+        for thread, functions in sorted(self.threads.items(), key=lambda t: -sum(t[1].values())):
+            f.write(f'\n{thread}: {sum(functions.values()):.3f}\n')
+            for function, t in functions.most_common(10):
+                f.write(f'{t:10.3f}  {function}\n')
+
+
+class DeterministicProfiler:
+    '''Records every function call made while handling messages (exact call counts, higher overhead)'''
+
+    def __init__(self, messenger):
+        self.m = messenger
+        self.stats = {}  # Message type --> pstats.Stats
+        self.skipped = 0  # Messages handled without profiling
+        self.lock = Lock()
+        # Only one profiler may be active at a time since Python 3.12, so handler threads take turns
+        self.profiling = Lock()
+
+    def start(self):
+        self.started = time.time()
+        # Each message is handled on its own thread, so every call gets its own profile
+        self.handler = self.m.message_handler
+        self.m.message_handler = self.profiled_handler
+
+    def stop(self):
+        self.m.message_handler = self.handler
+        self.elapsed = time.time() - self.started
+
+    def profiled_handler(self, msg):
+        # Messages arriving while another one is profiled are handled without profiling (never dropped)
+        if not self.profiling.acquire(blocking=False):
+            return self.unprofiled_handler(msg)
+        try:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:  # Another profiling tool is active
+                return self.unprofiled_handler(msg)
+            try:
+                self.handler(msg)
+            finally:
+                profile.disable()
+        finally:
+            self.profiling.release()
+
+        with self.lock:
+            name = type(msg).__name__
+            if name in self.stats:
+                self.stats[name].add(profile)
+            else:
+                self.stats[name] = pstats.Stats(profile)
+
+    def unprofiled_handler(self, msg):
+        with self.lock:
+            self.skipped += 1
+        self.handler(msg)
+
+    def report(self, f):
+        f.write(f'Deterministic profile of message handling over {self.elapsed:.1f} seconds\n')
+        if self.skipped:
+            f.write(f'{self.skipped} messages handled without profiling (another message was being profiled)\n')
+        if not self.stats:
+            f.write('\nNo messages handled\n')
+            return
+        combined = pstats.Stats(stream=f)
+        combined.add(*self.stats.values())
+        f.write('\nAll messages:\n')
+        combined.sort_stats('tottime').print_stats(PROFILE_TOP)
+
+        # Breakdown per message type (handled on separate threads)
+        for name, stats in sorted(self.stats.items()):
+            f.write(f'\n{name} handler threads:\n')
+            stats.stream = f
+            stats.sort_stats('tottime').print_stats(10)
+
+
+def start_profiler(messenger, mode: str = 'sampling', seconds: float = PROFILE_DURATION):
+    '''Profile running node for given number of seconds (or until stopped)'''
+    global active
+    with profiler_lock:
+        if active is not None:
+            log('Profiler is already running')
+            return
+        active = DeterministicProfiler(messenger) if mode == 'deterministic' else SamplingProfiler()
+        active.start()
+    log(f'Started {mode} profiler for {seconds} seconds')
+    threading.Timer(seconds, stop_profiler, args=[active]).start()
+
+
+def stop_profiler(profiler=None):
+    '''Stop running profiler (only if it is the given one) and write its report to file'''
+    global active
+    with profiler_lock:
+        if active is None or (profiler is not None and profiler is not active):
+            return
+        profiler, active = active, None
+    profiler.stop()
+
+    filename = f'profile_{SELF_TYPE.lower()}_{SELF_PID}_{int(time.time())}.txt'
+    with open(filename, 'w') as f:
+        profiler.report(f)
+    log(f'Profile written to {filename}')
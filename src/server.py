@@ -1,37 +1,87 @@
-from queue import Queue
+from collections import OrderedDict
+import copy
 import math
-from threading import Lock
+import time
+import random
+import threading
+from threading import Lock, RLock
 
 from messages import *
 from blockchain import *
 from dictionary import *
+from admission import *
+from blobs import *
+from bulk import *
 from constants import *
 
 promise_lock = Lock()
-accept_lock = Lock()
+# Guards leader's proposal state (value being proposed, request, accept responses)
+propose_lock = RLock()
+watch_lock = Lock()
+blob_lock = Lock()
 
 
 class Server:
     def __init__(self):
+        # Restore blockchain before the messenger starts its threads (verification forks worker processes)
+        if NUM_SHARDS > 1:
+            self.b = Blockchain(
+                filename=f'blockchain_backup_{SELF_SHARD}_{SELF_PID}.txt')
+            self.blobs = BlobStore(f'blobs_{SELF_SHARD}_{SELF_PID}')
+        else:
+            self.b = Blockchain(filename=f'blockchain_backup_{SELF_PID}.txt')
+            self.blobs = BlobStore(f'blobs_{SELF_PID}')
+        # Time each missing blob was last requested: digest --> time
+        self.blob_requests = {}
+        # Reads answered once their blob is received: digest --> [(response, client pid, blob reference)]
+        self.blob_waiters = {}
+        # Time missing decided blocks were last requested
+        self.recovery_requested = 0
         self.m = Messenger(self.message_handler)
-        self.b = Blockchain(filename=f'blockchain_backup_{SELF_PID}.txt')
         self.d = Dictionary()
-        self.update_dictionary()
 
         # Acceptor data
         # Latest ballot in which server was involved (phase 1)
         self.ballot = Ballot(0, 0, 0)
-        # Latest ballot in which server accepted value (phase 2)
-        self.acceptNum = Ballot(0, 0, 0)
-        # Latest accepted value (phase 2)
-        self.acceptVal = None
+        # Accepted but undecided values (phase 2): depth --> (ballot, block)
+        self.accepted = {}
+        if self.b.is_tentative():
+            self.accepted[self.b.depth - 1] = (Ballot(0, 0, 0), self.b.blocks[-1])
         self.leaderID = -1
+        # Recently decided request IDs (oldest first)
+        self.completed = OrderedDict()
+        # Next depth to deliver for each watch subscription: (client PID, prefix, keys only) --> depth
+        self.watches = {}
+        self.update_dictionary()
 
         # Leader data
+        # Value currently being proposed (None when idle) and its digest
         self.value = None
+        self.digest = None
+        # Whether current value was recovered from a previous leader
+        self.recovering = False
+        # Undecided values reported by promises: depth --> (ballot, block)
+        self.recovered = {}
+        # Highest decided depth reported by promises and the server reporting it
+        # (its decided blocks are fetched before anything new is proposed)
+        self.promised = (0, -1)
+        # Servers which accepted current value
+        self.acceptors = set()
         self.promise_responses = 0
         self.accept_responses = 0
-        self.queue = Queue()
+        # Pending client requests and request currently being proposed
+        self.queue = AdmissionQueue()
+        self.request = None
+
+        threading.Thread(target=self.watch_thread).start()
+        threading.Thread(target=self.expire_thread).start()
+
+        # Failure detector data
+        # Time by which the leader must be heard from before an election is started
+        self.leader_deadline = 0
+        self.reset_election_timer()
+        threading.Thread(target=self.heartbeat_thread).start()
+        threading.Thread(target=self.anti_entropy_thread).start()
 
     def connect(self):
         self.m.connect()
@@ -39,8 +89,96 @@ class Server:
     def close(self):
         self.m.close()
 
-    def send_message(self, message, pid=-1, recipientType='Server'):
-        self.m.send_message(message, pid, recipientType)
+    def send_message(self, message, pid=-1, recipientType='Server', delay=NETWORK_DELAY, verbose=True):
+        self.m.send_message(message, pid, recipientType, delay, verbose)
+
+    def reset_election_timer(self):
+        '''Push back leader deadline by a randomized election timeout'''
+        timeout = ELECTION_TIMEOUT + random.uniform(0, ELECTION_BACKOFF)
+        self.leader_deadline = time.time() + timeout
+
+    def heartbeat_thread(self):
+        '''Send heartbeats while leader, otherwise start an election if the leader goes quiet'''
+        while True:
+            time.sleep(HEARTBEAT_INTERVAL)
+            if not self.m.connected:
+                continue
+
+            # Fetch blocks discarded from corrupted backup (from the leader, once known)
+            if self.b.corrupted is not None and self.leaderID not in [-1, SELF_PID]:
+                log(f'Requesting repair of blocks from #{self.b.depth}')
+                self.b.corrupted = None
+                self.send_message(RecoveryRequest(self.b.depth), self.leaderID)
+
+            # Keep asking for batches holding back decided blocks and blobs awaited by reads
+            # (the server asked last may not hold them either)
+            if self.d.latestDepth < self.b.decided_depth():
+                self.update_dictionary()
+            with blob_lock:
+                awaited = [waiters[0][2] for waiters in self.blob_waiters.values()]
+            for ref in awaited:
+                self.request_blob(ref)
+
+            if self.leaderID == SELF_PID:
+                self.send_message(Heartbeat(self.ballot),
+                                  delay=0, verbose=False)
+
+            # Only elect a replacement once a leader has been chosen
+            elif self.leaderID != -1 and time.time() > self.leader_deadline:
+                log(f'Leader {self.leaderID} timed out, starting election')
+                # Election messages are not delayed, so a timeout covers the round trip
+                self.reset_election_timer()
+                self.send_prepare_request()
+
+    def anti_entropy_thread(self):
+        '''Periodically compare decided blocks with the leader (one probe when in sync)'''
+        while True:
+            time.sleep(ANTI_ENTROPY_INTERVAL)
+            if not self.m.connected or self.leaderID in [-1, SELF_PID]:
+                continue
+            depth = self.b.decided_depth()
+            if depth:
+                self.send_message(SyncProbe(0, depth, self.b.checkpoints(0, depth)),
+                                  self.leaderID, verbose=False)
+
+    def check_probe(self, msg: SyncProbe):
+        '''Compare probe with own prefix digests, narrowing down the first divergent block'''
+        decided = self.b.decided_depth()
+        low, high = msg.low, None
+        for depth, digest in msg.checkpoints:
+            if depth > decided:
+                break
+            if self.b.prefix_digest(depth) != digest:
+                high = depth
+                break
+            low = depth
+
+        # Blockchains match up to the shorter one (leader sends decided blocks a shorter follower is missing)
+        if high is None:
+            if self.leaderID == SELF_PID and low == msg.high:
+                self.send_decided_blocks(msg.pid, low)
+            return
+        # First divergent block found, repair is done by the follower
+        if high - low == 1:
+            log(f'Blockchain diverges from Server #{msg.pid} at block #{low}')
+            if self.leaderID == SELF_PID:
+                self.send_message(SyncDiverged(low), msg.pid)
+            else:
+                self.repair(low)
+        # Ask sender to compare the (smaller) divergent range
+        else:
+            self.send_message(SyncProbe(low, high, self.b.checkpoints(low, high)),
+                              msg.pid, verbose=False)
+
+    def repair(self, depth: int):
+        '''Discard blocks from depth onward, rebuild dictionary, and fetch replacements from the leader'''
+        log(f'Repairing blocks from #{depth}')
+        self.b.truncate(depth)
+        self.d = Dictionary()
+        self.update_dictionary()
+        # Earlier request was for blocks following the discarded ones
+        self.recovery_requested = 0
+        self.request_recovery(self.leaderID)
 
     def tentative(self, block: Block):
         block.tentative = True
@@ -57,12 +195,79 @@ class Server:
             self.b.append(block)
         self.update_dictionary()
 
+    def fetch_blob(self, block: Block, pid: int = None):
+        '''Request value of block from given server if it is a blob which has not been received yet'''
+        self.request_blob(block.operation.value, pid)
+
+    def blob_source(self) -> int:
+        '''Server to request a blob from if no server is known to hold it (leader, or any other server when leading)'''
+        if self.leaderID not in [-1, SELF_PID]:
+            return self.leaderID
+        return random.choice([pid for pid in range(NUM_SERVERS) if pid != SELF_PID])
+
+    def request_blob(self, ref, pid: int = None) -> bool:
+        '''Request referenced blob from one server unless it has been received or was requested recently (True if requested)'''
+        if isinstance(ref, BlobRef) and ref.digest not in self.blobs:
+            pid = self.blob_source() if pid is None else pid
+            # Blob may still be in transit from an earlier request
+            if time.time() - self.blob_requests.get(ref.digest, 0) < BLOB_REQUEST_TIMEOUT:
+                return False
+            self.blob_requests[ref.digest] = time.time()
+            self.send_message(BlobRequest(ref.digest), pid, verbose=False)
+            return True
+        return False
+
+    def resolve(self, value):
+        '''Value stored in dictionary with blob references replaced by their contents'''
+        result = self.blobs.get(value)
+        if isinstance(value, BlobRef) and result is None:
+            self.request_blob(value)
+            return 'BLOB_UNAVAILABLE'
+        return result
+
+    def send_blob(self, digest: str, pid: int):
+        chunks = self.blobs.chunks(digest)
+        log(f'Sending blob {digest[:16]} to Server #{pid} ({len(chunks)} chunks)')
+        for i, chunk in enumerate(chunks):
+            self.send_message(BlobChunk(digest, i, len(chunks), chunk),
+                              pid, verbose=False)
+
+    def forget_decided(self):
+        '''Drop accepted values for depths that have since been decided'''
+        depth = self.b.decided_depth()
+        self.accepted = {d: a for d, a in self.accepted.items() if d >= depth}
+
     def fulfill(self, request: ClientRequest):
+        value = None
         # Fulfill GET request with data from key-value store
         if request.operation.op == OpType.GET:
+            value = self.d[request.operation.key]
+            response = ClientResponse(
+                op=request.operation,
+                message=self.resolve(value),
+                depth=self.d.latestDepth,
+                expires=self.d.expiry.get(request.operation.key)
+            )
+        # Fulfill FIND request with keys from secondary index
+        elif request.operation.op == OpType.FIND:
+            response = ClientResponse(
+                op=request.operation,
+                message=self.d.find(request.operation.key,
+                                    *request.operation.value)
+            )
+        # Fulfill GET_AT request with data from version history
+        elif request.operation.op == OpType.GET_AT:
+            value = self.d.get_at(request.operation.key, request.operation.value)
             response = ClientResponse(
                 op=request.operation,
-                message=self.d[request.operation.key]
+                message=self.resolve(value)
+            )
+        # Fulfill BATCH request with acknowledgement (pairs are not sent back)
+        elif request.operation.op == OpType.BATCH:
+            response = ClientResponse(
+                op=Operation(OpType.BATCH, request.operation.key,
+                             request_id=request.operation.request_id),
+                message=f'{len(request.operation.value)} keys written'
             )
         # Fulfill PUT request with acknowledgement
         else:
@@ -71,10 +276,89 @@ class Server:
                 message="It will be done, my lord."
             )
 
+        # Blob has not been received yet, answer once it is (as of this read's depth)
+        if isinstance(value, BlobRef):
+            with blob_lock:
+                if value.digest not in self.blobs:
+                    self.blob_waiters.setdefault(value.digest, []).append((response, request.pid, value))
+                    return
+            response.message = self.blobs.get(value)
         self.send_message(response, request.pid, 'Client')
 
     def update_dictionary(self):
-        self.d.update(self.b.blocks, self.b.depth)
+        depth = self.b.decided_depth()
+        # Blocks are applied in order, so a batch which has not been received holds back the blocks after it
+        for i in range(self.d.latestDepth, depth):
+            op = self.b.blocks[i].operation
+            if op.op is OpType.BATCH and isinstance(op.value, BlobRef) and op.value.digest not in self.blobs:
+                if self.request_blob(op.value):
+                    log(f'Waiting for batch of block #{i}')
+                depth = i
+                break
+        # Remember recently decided requests to suppress duplicates
+        for block in self.b.blocks[self.d.latestDepth:depth]:
+            request_id = getattr(block.operation, 'request_id', None)
+            if request_id is not None:
+                self.completed[request_id] = True
+                if len(self.completed) > DEDUP_WINDOW:
+                    self.completed.popitem(last=False)
+        self.d.update(self.b.blocks, depth, resolve=self.blobs.get)
+        self.forget_decided()
+        self.notify_watchers()
+
+    def notify_watchers(self):
+        '''Send decided PUT operations to subscribers (one page per subscription, slow subscribers are skipped)'''
+        # Only blocks applied to the dictionary (batches may still be in transit)
+        decided = self.d.latestDepth
+
+        with watch_lock:
+            for (pid, prefix, keys_only), depth in list(self.watches.items()):
+                if depth >= decided:
+                    continue
+                # Subscriber is not keeping up, resume from its cursor later
+                if self.m.outgoing['Client'][pid].qsize() >= WATCH_MAX_PENDING:
+                    continue
+
+                changes = []
+                while depth < decided and len(changes) < WATCH_BATCH_SIZE:
+                    op = self.b.blocks[depth].operation
+                    depth += 1
+                    for key, value in op.writes(self.blobs.get):
+                        if str(key).startswith(prefix):
+                            changes.append(
+                                (depth, key, None if keys_only else self.resolve(value)))
+
+                self.watches[(pid, prefix, keys_only)] = depth
+                if changes:
+                    self.send_message(Notification(prefix, changes, depth, keys_only),
+                                      pid, 'Client')
+
+    def watch_thread(self):
+        '''Periodically resume paused or partially delivered subscriptions'''
+        while True:
+            time.sleep(WATCH_INTERVAL)
+            self.notify_watchers()
+
+    def export(self, filename: str, history: bool = False):
+        '''Stream key-value store (or every decided write with its depth) to JSON lines file'''
+        start = time.time()
+        if history:
+            records = ({'depth': i + 1, 'key': key, 'value': self.resolve(value)}
+                       for i in range(self.d.latestDepth)
+                       for key, value in self.b.blocks[i].operation.writes(self.blobs.get))
+        else:
+            records = ({'key': key, 'value': self.resolve(value)}
+                       for key, value in self.d.items())
+        count = write_records(filename, records)
+        log(f'Exported {count} records to {filename} in {time.time() - start:.1f} seconds')
+
+    def expire_thread(self):
+        '''Periodically reclaim expired keys (they are already hidden from reads)'''
+        while True:
+            time.sleep(EXPIRE_INTERVAL)
+            removed = self.d.expire()
+            if removed:
+                log(f'Removed {removed} expired keys')
 
     # def propose(self, op: Operation):
     #     self.value = self.b.generate_next_block(op)
@@ -83,34 +367,168 @@ class Server:
     #     self.ballot = Ballot(self.b.depth, self.ballot.num + 1, SELF_PID)
     #     self.send_message(PrepareRequest(self.ballot))
 
-    def send_prepare_request(self, value: Operation):
-        self.accept_responses = 0
-        self.promise_responses = 0
-        self.ballot = Ballot(self.b.depth, self.ballot.num + 1, SELF_PID)
-        self.value = self.b.generate_next_block(value)
-        print('New block generated:')
-        print(str(self.value))
-        self.send_message(PrepareRequest(self.ballot, self.b.depth))
+    def send_prepare_request(self):
+        '''Phase 1 for every depth from the last decided block onward (run once per leadership)'''
+        with propose_lock:
+            self.accept_responses = 0
+            self.promise_responses = 0
+            self.ballot = Ballot(self.b.decided_depth(),
+                                 self.ballot.num + 1, SELF_PID)
+            self.value = None
+            self.recovered = dict(self.accepted)
+            self.promised = (0, -1)
+        # Elections are not subject to the simulated network delay (like heartbeats)
+        self.send_message(PrepareRequest(self.ballot, self.b.decided_depth()),
+                          delay=0)
 
     def send_accept_request(self, value: Operation):
-        self.accept_responses = 0
-        self.promise_responses = 0
-        self.ballot = Ballot(self.b.depth, self.ballot.num + 1, SELF_PID)
-        self.value = self.b.generate_next_block(value)
+        self.recovering = False
+        # Large values (and batches) are replaced by a reference (blob is fetched by other servers separately)
+        if value.op in [OpType.PUT, OpType.BATCH]:
+            value = copy.copy(value)
+            value.value = self.blobs.put(value.value)
+        block = self.b.generate_next_block(value)
         print('New block generated:')
-        print(str(self.value))
-        self.send_message(AcceptRequest(self.ballot, self.value, self.b.depth))
+        print(str(block))
+        self.propose(block)
+
+    def propose(self, block: Block):
+        '''Phase 2 for next depth (ballot from phase 1 is reused for every depth while leader)'''
+        request = AcceptRequest(self.ballot, block, self.b.decided_depth())
+        quorum = self.thrifty_quorum()
+        self.accept_responses = 0
+        self.acceptors = set()
+        self.value = block
+        self.digest = block.digest()
+
+        if not THRIFTY_QUORUM:
+            self.send_message(request)
+            return
+
+        # Only ask as many servers as are needed for a majority, widening on timeout
+        self.send_message(request, quorum)
+        threading.Timer(ACCEPT_TIMEOUT, self.widen_accept_request,
+                        args=[request, quorum]).start()
+
+    def thrifty_quorum(self):
+        '''Reachable servers needed for a majority (preferring those which accepted the last value)'''
+        needed = math.ceil(NUM_SERVERS / 2) - 1
+        others = [(SELF_PID + i) % NUM_SERVERS for i in range(1, NUM_SERVERS)]
+        reachable = [pid for pid in others
+                     if self.m.servers[pid] is not None and not self.m.is_failed('Server', pid)]
+        reachable.sort(key=lambda pid: pid not in self.acceptors)
+        return reachable[:needed] if len(reachable) >= needed else others
+
+    def widen_accept_request(self, request: AcceptRequest, quorum):
+        # Still waiting on a majority for the same value
+        if self.value is request.value and self.accept_responses >= 0:
+            rest = [pid for pid in range(NUM_SERVERS)
+                    if pid != SELF_PID and pid not in quorum]
+            if rest:
+                log('Accept request timed out, widening to remaining servers')
+                self.send_message(request, rest)
+
+    def send_decide(self):
+        '''Phase 3 (block is only sent to servers which have not accepted it)'''
+        depth = self.b.decided_depth()
+        digest = self.digest
+        others = [pid for pid in range(NUM_SERVERS) if pid != SELF_PID]
+        accepted = [pid for pid in others if pid in self.acceptors]
+        missing = [pid for pid in others if pid not in self.acceptors]
+        if accepted:
+            self.send_message(Decide(self.ballot, depth, digest), accepted)
+        if missing:
+            self.send_message(
+                Decide(self.ballot, depth, digest, self.value), missing)
+
+    def propose_next(self):
+        '''Re-propose recovered value for next depth if one exists, otherwise next queued request'''
+        depth = self.b.decided_depth()
+        # Promisers decided blocks this server is missing, proposing now would overwrite them
+        if depth < self.promised[0]:
+            self.value = None
+            self.request_recovery(self.promised[1])
+            return
+        self.recovered = {d: r for d, r in self.recovered.items() if d >= depth}
+
+        if depth in self.recovered:
+            block = self.recovered.pop(depth)[1]
+            # Only re-propose blocks which extend this server's blockchain
+            if block.hash_pointer == self.b.next_hash_pointer():
+                log(f'Re-proposing recovered block #{depth}')
+                self.recovering = True
+                self.propose(block)
+                return
+
+        # Requests may have been decided by another leader since they were queued
+        self.request = self.queue.get()
+        while self.request is not None and self.request.operation.request_id in self.completed:
+            log(f'Request {self.request.operation.request_id} already decided, skipping')
+            self.request = self.queue.get()
+        if self.request is not None:
+            self.send_accept_request(self.request.operation)
+        else:
+            self.value = None
+
+    def step_down(self, ballot: Ballot):
+        '''Drop queued requests and current proposal once another server holds a higher ballot (clients resend to it)'''
+        if ballot.pid == SELF_PID or ballot <= self.ballot:
+            return
+        with propose_lock:
+            if self.value is not None or not self.queue.empty():
+                log(f'Server #{ballot.pid} holds a higher ballot, dropping queued requests')
+            self.queue.clear()
+            self.request = None
+            self.value = None
+
+    def admit(self, request: ClientRequest) -> bool:
+        '''Add client request to queue (duplicates are dropped, busy response is sent if queue is full)'''
+        request_id = request.operation.request_id
+        if request_id is not None:
+            if request_id in self.completed:
+                log(f'Request {request_id} already decided, responding again')
+                self.fulfill(request)
+                return False
+            if request_id in self.queue or (
+                    self.request is not None and self.request.operation.request_id == request_id):
+                log(f'Ignoring duplicate request {request_id}')
+                return False
+
+        if not self.queue.put(request):
+            log('Queue is full, asking client to retry later')
+            self.send_message(Busy(request.operation, RETRY_AFTER),
+                              request.pid, 'Client')
+            return False
+        return True
 
     def send_recovery_data(self, pid: int, depth: int):
-        # Send recovery data (if necessary)
-        if depth < self.b.depth - 1:
+        # Send recovery data (if necessary, tentative block is never sent)
+        decided = self.b.decided_depth()
+        if depth < decided - 1:
             log(f'Sending recovery data to Server #{pid}')
-            for i in range(depth, self.b.depth):
+            for i in range(depth, decided):
                 self.send_message(
                     RecoveryData(i + 1, self.b.blocks[i]),
                     pid
                 )
 
+    def request_recovery(self, pid: int):
+        '''Ask server (the leader) for decided blocks following this server's last decided block'''
+        if time.time() - self.recovery_requested < RECOVERY_TIMEOUT:
+            return
+        self.recovery_requested = time.time()
+        log(f'Requesting blocks from #{self.b.decided_depth()}')
+        self.send_message(RecoveryRequest(self.b.decided_depth()), pid)
+
+    def send_decided_blocks(self, pid: int, depth: int):
+        '''Send every decided block from depth onward (in response to an explicit request)'''
+        decided = self.b.decided_depth()
+        if depth < decided:
+            log(f'Sending blocks #{depth} to #{decided - 1} to Server #{pid}')
+            for i in range(depth, decided):
+                self.send_message(RecoveryData(i + 1, self.b.blocks[i]),
+                                  pid, verbose=False)
+
     def majority_responded(self, responses: int):
         return responses >= math.ceil(NUM_SERVERS / 2) - 1
 
@@ -119,30 +537,38 @@ class Server:
 
         # Client Request (GET or PUT operation)
         if type(msg) is ClientRequest:
+            # Key belongs to another shard
+            if msg.operation.op != OpType.FIND and shard_of(msg.operation.key) != SELF_SHARD:
+                self.send_message(ClientResponse(msg.operation, 'WRONG_SHARD'),
+                                  msg.pid, 'Client')
+
             # This server is the leader
-            if self.leaderID == SELF_PID:
-                self.queue.put(msg)
-                if len(self.queue.queue) == 1:
-                    self.send_accept_request(msg.operation)
+            elif self.leaderID == SELF_PID:
+                # Only one value may be proposed at a time
+                with propose_lock:
+                    if self.admit(msg) and self.value is None:
+                        self.propose_next()
 
             # No leader has been chosen (or client is forcing leader selection)
             elif self.leaderID == -1 or msg.force_leader:
-                self.queue.put(msg)
-                self.send_prepare_request(msg.operation)
+                if self.admit(msg):
+                    self.send_prepare_request()
 
             # Another server is the leader
             else:
-                self.send_message(msg, msg.pid)
+                self.send_message(msg, self.leaderID)
 
         # Phase 1B
         if type(msg) is PrepareRequest:
             if msg.ballot >= self.ballot:
+                self.step_down(msg.ballot)
                 self.leaderID = msg.ballot.pid
                 self.ballot = msg.ballot
+                self.reset_election_timer()
                 self.send_message(
-                    Promise(msg.ballot, self.acceptNum,
-                            self.acceptVal, self.b.depth),
-                    msg.ballot.pid
+                    Promise(msg.ballot, self.accepted, self.b.decided_depth()),
+                    msg.ballot.pid,
+                    delay=0
                 )
             # Send recovery data (if necessary)
             self.send_recovery_data(msg.pid, msg.depth)
@@ -150,64 +576,163 @@ class Server:
         # Phase 2A
         elif type(msg) is Promise:
             with promise_lock:
+                # Late promises for an earlier ballot do not count toward this one
+                if msg.ballot != self.ballot:
+                    return
                 self.promise_responses += 1
-                if msg.ballot > self.ballot and msg.value is not None:
-                    self.value = msg.value
+                # Keep value accepted with highest ballot at each depth
+                for depth, (num, block) in msg.accepted.items():
+                    if depth not in self.recovered or self.recovered[depth][0] < num:
+                        self.recovered[depth] = (num, block)
+                        self.fetch_blob(block, msg.pid)
+                if msg.depth > self.promised[0]:
+                    self.promised = (msg.depth, msg.pid)
                 if self.majority_responded(self.promise_responses):
-                    self.responses = -NUM_SERVERS
+                    self.promise_responses = -NUM_SERVERS
                     self.leaderID = msg.ballot.pid
-                    self.send_message(AcceptRequest(
-                        self.ballot, self.value, self.b.depth))
+                    log('Elected leader')
+                    self.send_message(LeaderChange(SELF_PID),
+                                      recipientType='Client')
+                    if self.promised[0] > self.b.decided_depth():
+                        log(f'Server #{self.promised[1]} decided blocks up to #{self.promised[0] - 1}, fetching them first')
+                        self.recovery_requested = 0
+                    # Finish undecided values before serving new requests
+                    with propose_lock:
+                        self.propose_next()
 
             # Send recovery data (if necessary)
             self.send_recovery_data(msg.pid, msg.depth)
 
         # Phase 2B
         elif type(msg) is AcceptRequest:
-            if msg.ballot >= self.ballot:
-                self.acceptNum = msg.ballot
-                self.acceptVal = msg.value
-                self.tentative(msg.value)
+            # Depth was already decided (leader is missing decided blocks), send them instead of accepting
+            if msg.depth < self.b.decided_depth():
+                log(f'Refusing accept request for decided block #{msg.depth}')
+                self.send_decided_blocks(msg.pid, msg.depth)
+            elif msg.ballot >= self.ballot:
+                self.accepted[msg.depth] = (msg.ballot, msg.value)
+                # Block only extends blockchain if no earlier decision was missed
+                if msg.depth == self.b.decided_depth():
+                    self.tentative(msg.value)
+                else:
+                    self.request_recovery(msg.pid)
+                self.fetch_blob(msg.value, msg.pid)
                 self.send_message(
-                    Accept(msg.ballot, msg.value, self.b.depth),
+                    Accept(msg.ballot, msg.value.digest(), self.b.depth),
                     msg.ballot.pid
                 )
 
-            # Send recovery data (if necessary)
-            self.send_recovery_data(msg.pid, msg.depth)
-
         # Phase 3A
         elif type(msg) is Accept:
-            with accept_lock:
+            with propose_lock:
+                # Ignore acceptances of other values (e.g. late ones for previously decided depths)
+                if self.value is None or msg.ballot != self.ballot or msg.digest != self.digest:
+                    return
                 self.accept_responses += 1
+                self.acceptors.add(msg.pid)
                 if self.majority_responded(self.accept_responses):
                     self.accept_responses = -NUM_SERVERS
-                    self.send_message(
-                        Decide(self.ballot, self.value), recipientType='All')
+                    self.send_decide()
                     self.decide(self.value)
-                    self.fulfill(self.queue.get())
-                    if not self.queue.empty():
-                        self.send_accept_request(
-                            self.queue.queue[0].operation)
+                    # Recovered values belong to requests of a previous leader
+                    if not self.recovering:
+                        # Leader must move on to the next request even if this response fails
+                        try:
+                            self.fulfill(self.request)
+                        except Exception as e:
+                            log(f'Failed to fulfill request {self.request.operation}: {e}')
+                    self.propose_next()
 
             # Send recovery data (if necessary)
             self.send_recovery_data(msg.pid, msg.depth)
 
         # Phase 3B
         elif type(msg) is Decide:
-            log(f'Value in block received: {msg.value.operation.value}')
-            self.decide(msg.value)
+            block = msg.value
+            # Lightweight decide: use previously accepted block with matching digest
+            if block is None and msg.depth in self.accepted:
+                accepted = self.accepted[msg.depth][1]
+                if accepted.digest() == msg.digest:
+                    block = accepted
+            decided = self.b.decided_depth()
+            # Earlier decision was missed (or decided block was never received)
+            if msg.depth > decided or (msg.depth == decided and block is None):
+                log(f'Missing decided block #{decided}, requesting recovery')
+                self.request_recovery(msg.pid)
+            elif msg.depth == decided:
+                log(f'Value in block received: {block.operation.value}')
+                self.fetch_blob(block, msg.pid)
+                self.decide(block)
+
+        # Watch subscriptions (served by any server from its decided blocks)
+        elif type(msg) is Subscribe:
+            depth = self.b.decided_depth() if msg.depth is None else msg.depth
+            log(f'Client {msg.pid} watching "{msg.prefix}" from block #{depth}')
+            with watch_lock:
+                self.watches[(msg.pid, msg.prefix, msg.keys_only)] = depth
+            # Acknowledge subscription with its starting depth
+            self.send_message(Notification(msg.prefix, [], depth, msg.keys_only),
+                              msg.pid, 'Client')
+            self.notify_watchers()
+
+        elif type(msg) is Unsubscribe:
+            with watch_lock:
+                self.watches.pop((msg.pid, msg.prefix, msg.keys_only), None)
+
+        # Leader liveness
+        elif type(msg) is Heartbeat:
+            if msg.ballot >= self.ballot:
+                self.step_down(msg.ballot)
+                self.leaderID = msg.pid
+                self.ballot = msg.ballot
+                self.reset_election_timer()
+
+        # Anti-entropy
+        elif type(msg) is SyncProbe:
+            self.check_probe(msg)
+
+        elif type(msg) is SyncDiverged:
+            if msg.pid == self.leaderID and msg.depth < self.b.decided_depth():
+                self.repair(msg.depth)
+
+        # Large values (transferred separately from the blocks referencing them)
+        elif type(msg) is BlobRequest:
+            if msg.digest in self.blobs:
+                self.send_blob(msg.digest, msg.pid)
+
+        elif type(msg) is BlobChunk:
+            if self.blobs.add_chunk(msg.digest, msg.index, msg.count, msg.data):
+                log(f'Received blob {msg.digest[:16]}')
+                self.blob_requests.pop(msg.digest, None)
+                # Batch may have held back decided blocks
+                if self.d.latestDepth < self.b.decided_depth():
+                    self.update_dictionary()
+                with blob_lock:
+                    waiters = self.blob_waiters.pop(msg.digest, [])
+                for response, pid, ref in waiters:
+                    response.message = self.blobs.get(ref)
+                    self.send_message(response, pid, 'Client')
+
+        # Send blocks requested for repair
+        elif type(msg) is RecoveryRequest:
+            self.send_decided_blocks(msg.pid, msg.depth)
 
         # Recover Data (Repair blockchain with missing blocks)
         elif type(msg) is RecoveryData:
-            if self.b.depth == msg.depth - 1:
+            # Next decided block (replaces tentative block if it was accepted but never decided)
+            if self.b.decided_depth() == msg.depth - 1 and \
+                    msg.block.hash_pointer == self.b.next_hash_pointer():
                 log('Received recovery data')
-                self.b.append(msg.block)
-                self.update_dictionary()
-                # If leader, recalculate next block after repairing blockchain
-                if self.leaderID == SELF_PID:
-                    self.value = self.b.generate_next_block(
-                        self.value.operation)
+                self.fetch_blob(msg.block, msg.pid)
+                self.decide(msg.block)
+                # If leader, propose next block again after repairing blockchain
+                # (or start proposing once blocks decided before its election have been fetched)
+                with propose_lock:
+                    if self.leaderID == SELF_PID:
+                        if self.value is not None and not self.recovering:
+                            self.send_accept_request(self.request.operation)
+                        else:
+                            self.propose_next()
 
         # Test
         elif type(msg) is Test: